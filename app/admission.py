@@ -0,0 +1,146 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+DB admission control.  Every DB call (sql.fetchone(), sql.fetchall(), and db.py's own
+executes) runs within a slot(); at most settings.k_db_concurrency run at once, and the
+rest queue by priority class, highest first:
+	quiz > login > username_check > resource_search > admin_list
+so that a burst of resource searches can't starve ws_quiz_handler.
+
+Handlers declare their class (and get a deadline, per settings.k_db_deadlines) with
+admit(), once per request or websocket message; e.g.,
+	admission.admit('login')
+A full per-class queue (settings.k_db_queue_depths) sheds load immediately with Overloaded;
+a wait that outlives the deadline raises Deadline_Exceeded.  Both are Shed exceptions,
+which main.py turns into quick "busy, retry" replies.
+'''
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import metrics
+from . import settings
+
+priorities = ('quiz', 'login', 'username_check', 'resource_search', 'admin_list') # highest first
+
+class Shed(Exception):
+	pass
+
+class Overloaded(Shed):
+	pass
+
+class Deadline_Exceeded(Shed):
+	pass
+
+Ticket = collections.namedtuple('Ticket', 'priority deadline') # deadline is in loop.time() terms, or None
+
+_ticket = contextvars.ContextVar('admission_ticket', default = Ticket(priorities[-1], None)) # un-admitted work (warm-up, scaffolding...) goes last
+_holding = contextvars.ContextVar('admission_holding', default = False)
+
+
+def admit(priority):
+	'''
+	Set the priority class and deadline for DB work done by the current request / message.
+	'''
+	assert priority in priorities
+	deadline = asyncio.get_event_loop().time() + settings.k_db_deadlines[priority]
+	_ticket.set(Ticket(priority, deadline))
+
+@contextlib.asynccontextmanager
+async def slot():
+	if _holding.get(): # already within a slot (e.g., db.add_user() calling down); don't queue behind ourselves
+		yield
+		return
+	priority, deadline = _ticket.get()
+	loop = asyncio.get_event_loop()
+	start = loop.time()
+	await _controller.acquire(priority, deadline)
+	metrics.observe('admission.wait.' + priority, loop.time() - start)
+	token = _holding.set(True)
+	try:
+		yield
+	finally:
+		_holding.reset(token)
+		_controller.release()
+
+async def idle(timeout):
+	'''
+	Wait (up to `timeout` seconds) for all admitted and queued DB work to finish; see main._shutdown().
+	'''
+	loop = asyncio.get_event_loop()
+	end = loop.time() + timeout
+	while _controller.busy() and loop.time() < end:
+		await asyncio.sleep(0.05)
+	return not _controller.busy()
+
+
+class Controller:
+	def __init__(self, concurrency, queue_depths):
+		self.concurrency = concurrency
+		self.active = 0
+		self._queue_depths = queue_depths
+		self._queues = dict([(priority, collections.deque()) for priority in priorities])
+
+	def busy(self):
+		return self.active or any(self._queues.values())
+
+	async def acquire(self, priority, deadline):
+		if self.active < self.concurrency and not any(self._queues.values()):
+			self.active += 1
+			metrics.gauge('admission.active', self.active)
+			return
+		#else, queue (or shed):
+		queue = self._queues[priority]
+		if len(queue) >= self._queue_depths[priority]:
+			metrics.inc('admission.shed.' + priority)
+			raise Overloaded(priority)
+		loop = asyncio.get_event_loop()
+		waiter = loop.create_future()
+		queue.append(waiter)
+		metrics.gauge('admission.queued.' + priority, len(queue))
+		try:
+			await asyncio.wait_for(waiter, None if deadline is None else max(0, deadline - loop.time()))
+		except asyncio.TimeoutError:
+			if waiter.done() and not waiter.cancelled(): # handed a slot just as the deadline passed; pass it on
+				self.release()
+			else:
+				self._discard(priority, waiter)
+			metrics.inc('admission.deadline_exceeded.' + priority)
+			raise Deadline_Exceeded(priority)
+		except asyncio.CancelledError:
+			if waiter.done() and not waiter.cancelled(): # we were handed a slot just as we were cancelled; pass it on
+				self.release()
+			else:
+				self._discard(priority, waiter)
+			raise
+		# (slot handed over by release(); self.active already counts it)
+
+	def release(self):
+		for priority in priorities:
+			queue = self._queues[priority]
+			while queue:
+				waiter = queue.popleft()
+				metrics.gauge('admission.queued.' + priority, len(queue))
+				if not waiter.done(): # (else it timed out or was cancelled)
+					waiter.set_result(None) # hand our slot straight over
+					return
+		self.active -= 1
+		metrics.gauge('admission.active', self.active)
+
+	def _discard(self, priority, waiter):
+		queue = self._queues[priority]
+		try:
+			queue.remove(waiter)
+		except ValueError:
+			pass
+		metrics.gauge('admission.queued.' + priority, len(queue))
+
+_controller = Controller(settings.k_db_concurrency, settings.k_db_queue_depths)
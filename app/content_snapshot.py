@@ -0,0 +1,72 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+In-memory content snapshots (settings.k_content_in_memory).  The curriculum is small - a few
+thousand rows - so, rather than read it from disk (or the OS page cache) on every question,
+take() copies the content db, with sqlite's backup API, into a named, shared-cache, in-memory
+database, which main.init_db() ATTACHes as "content" in place of the file:
+
+	snapshot = await content_snapshot.take('ohs-content.db')
+	... "attach database '%s' as content" % snapshot.uri ...
+
+A shared-cache memory db lives as long as some connection has it open, so each Snapshot
+keeps one "keeper" connection; release() it once the snapshot is no longer attached (see
+main.swap_content_db(), which takes a fresh snapshot, swaps it in, then releases the old).
+
+Only the split user/content layout can do this: with a single db, the content tables are
+in "main", which sqlite searches before any attached db.
+'''
+
+import asyncio
+import itertools
+import os
+import sqlite3
+import time
+
+from urllib.request import pathname2url
+
+import logging
+l = logging.getLogger(__name__)
+
+k_name = 'ohs-content-snapshot-%d' # (unique per snapshot, so that the old and new can coexist during a swap)
+
+_numbers = itertools.count(1)
+
+class Snapshot:
+	__slots__ = ('uri', 'filename', '_keeper')
+	def __init__(self, uri, filename, keeper):
+		self.uri = uri
+		self.filename = filename
+		self._keeper = keeper
+
+async def take(filename):
+	'''
+	Copy the db at `filename` into a new in-memory db; returns the Snapshot.  The copy runs
+	on an executor thread, so the loop isn't held for it.
+	'''
+	start = time.perf_counter()
+	uri = 'file:%s?mode=memory&cache=shared' % (k_name % next(_numbers))
+	keeper = await asyncio.get_event_loop().run_in_executor(None, _copy, filename, uri)
+	l.info('content db "%s" snapshotted into memory (%s) in %.3f seconds' % (filename, uri, time.perf_counter() - start))
+	return Snapshot(uri, filename, keeper)
+
+def release(snapshot):
+	if snapshot and snapshot._keeper:
+		snapshot._keeper.close() # (the memory is freed once no other connection has it attached)
+		snapshot._keeper = None
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _copy(filename, uri):
+	source = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(filename)), uri = True)
+	try:
+		keeper = sqlite3.connect(uri, uri = True, check_same_thread = False) # (released from whatever thread)
+		source.backup(keeper)
+	finally:
+		source.close()
+	return keeper
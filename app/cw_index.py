@@ -0,0 +1,117 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+In-memory bitmap index of the grammar tables by cycle and week.
+
+Every quiz question and resource search filters on cycle and week range, which, in SQL,
+means a join against cycle_week on every query.  But the content only changes when it's
+republished or edited (see main._reload_content(), main._watch_data_version()), so, instead, build() reads each table's
+(id, cycle, week) once, and keeps, per table:
+	* a bitmap (a Python int; bit n set <=> record id n) per cycle
+	* a cumulative bitmap per week: weeks_through[w] holds every record in weeks 1..w
+So any set of cycles is an OR of per-cycle bitmaps, any week range (first, last) is
+weeks_through[last] & ~weeks_through[first - 1], and the filter is the AND of those two;
+e.g.,
+	bitmap = cw_index.select('science', (0, 2), (3, 6)) # cycles 0 and 2, weeks 3-6
+	ids = cw_index.ids(bitmap)
+select() returns None for a table that isn't indexed (yet), so callers can fall back to SQL.
+'''
+
+import collections
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import sql
+
+# -----------------------------------------------------------------------------
+
+k_tables = ('event', 'history', 'science', 'vocabulary', 'english', 'latin_vocabulary')
+
+class Table_Index:
+	__slots__ = ('all', 'cycles', 'weeks_through')
+	def __init__(self, all_ids, cells):
+		self.all = bits(all_ids) # including any records with no cw at all; these are only ever "selected" when nothing is filtered
+		self.cycles = collections.defaultdict(int)
+		weeks = collections.defaultdict(int)
+		for id, cycle, week in cells:
+			self.cycles[cycle] |= 1 << id
+			weeks[week] |= 1 << id
+		self.weeks_through = [0] # weeks_through[0] is "no weeks"
+		for week in range(1, max(weeks, default = 0) + 1):
+			self.weeks_through.append(self.weeks_through[-1] | weeks[week])
+
+	def select(self, cycles = None, week_range = None):
+		result = self.all
+		if cycles:
+			result = 0
+			for cycle in cycles:
+				result |= self.cycles.get(int(cycle), 0)
+		if week_range:
+			first, last = week_range
+			result &= self._through(last) & ~self._through(first - 1)
+		return result
+
+	def cell(self, id):
+		bit = 1 << id
+		cycle = next((cycle for cycle, bitmap in self.cycles.items() if bitmap & bit), None)
+		if cycle is None:
+			return None
+		first, last = 1, len(self.weeks_through) - 1 # binary search for the first week "through" which the record is included
+		if last < 1 or not self.weeks_through[last] & bit:
+			return None
+		while first < last:
+			middle = (first + last) // 2
+			if self.weeks_through[middle] & bit:
+				last = middle
+			else:
+				first = middle + 1
+		return cycle, first
+
+	def _through(self, week):
+		return self.weeks_through[max(0, min(int(week), len(self.weeks_through) - 1))]
+
+
+_indexes = dict() # {table: Table_Index}; replaced wholesale by build()
+
+async def build(db):
+	global _indexes
+	indexes = dict()
+	for table in k_tables:
+		all_ids = [r['id'] for r in await sql.fetchall(db, (f'select id from {table}', []))]
+		cells = await sql.fetchall(db, (f'select {table}.id, cw.cycle, cw.week from {table} join cycle_week as cw on {table}.cw = cw.id', []))
+		indexes[table] = Table_Index(all_ids, cells)
+	_indexes = indexes
+	l.info('cycle/week index built for %d tables' % len(indexes))
+
+def clear():
+	global _indexes
+	_indexes = dict()
+
+def select(table, cycles = None, week_range = None):
+	'''
+	Return the bitmap of `table` record ids in any of `cycles` and within (inclusive)
+	`week_range`, or None if `table` isn't indexed.  None (or empty) `cycles` or
+	`week_range` means "don't filter on that".
+	'''
+	index = _indexes.get(table)
+	return index.select(cycles, week_range) if index else None
+
+def cell(table, id):
+	'''
+	Return the (cycle, week) of `table` record `id`, or None if it has none, or `table` isn't indexed.
+	'''
+	index = _indexes.get(table)
+	return index.cell(id) if index else None
+
+def bits(ids):
+	result = 0
+	for id in ids or ():
+		result |= 1 << id
+	return result
+
+def ids(bitmap):
+	return [i for i, bit in enumerate(reversed(bin(bitmap)[2:])) if bit == '1']
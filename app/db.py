@@ -3,16 +3,24 @@ __copyright__ = '2020'
 __version__ = '0.1'
 __license__ = 'MIT'
 
+import asyncio
 import hashlib
 import re
+import time
 
 from os import urandom
 from random import shuffle
+from sqlite3 import OperationalError
 
 import logging
 l = logging.getLogger(__name__)
 
 from . import sql
+from . import admission
+from . import slowlog
+from . import cw_index
+from . import metrics
+from . import settings
 
 # -----------------------------------------------------------------------------
 # User stuff
@@ -21,21 +29,29 @@ _hash = lambda password, salt: hashlib.pbkdf2_hmac('sha256', bytes(password, 'UT
 
 async def add_user(db, username, password, email):
 	salt = urandom(32)
-	c = await db.cursor() # need cursor because we need lastrowid, only available via cursor
-	r = await c.execute('insert into user (username, password, salt, email) values (?, ?, ?, ?)', (username, _hash(password, salt), salt, email))
-	user_id = c.lastrowid
-	r = await c.execute('insert into user_role (user, role) values (?, 1)', (user_id,)) #TODO: hard-coded to "role #1, student" -- parameterize!
+	password_hash = _hash(password, salt) # (before taking a db slot; this is slow on purpose)
+	async with writing, admission.slot():
+		c = await db.cursor() # need cursor because we need lastrowid, only available via cursor
+		statement = ('insert into user (username, password, salt, email) values (?, ?, ?, ?)', (username, password_hash, salt, email))
+		start = time.perf_counter()
+		r = await c.execute(*statement)
+		slowlog.check(start, statement, c.rowcount)
+		user_id = c.lastrowid
+		statement = ('insert into user_role (user, role) values (?, 1)', (user_id,)) #TODO: hard-coded to "role #1, student" -- parameterize!
+		start = time.perf_counter()
+		r = await c.execute(*statement)
+		slowlog.check(start, statement, c.rowcount)
 	return user_id
 
-_get_users_limited = lambda limit: ('select * from user limit ?', (limit,))
-async def get_users_limited(db, limit):
-	c = await db.execute(*_get_users_limited(limit))
-	return await c.fetchall()
+k_user_fields = ('id', 'username', 'email') # the default projection for user queries; never password or salt (only authenticate() needs those)
 
-_find_users = lambda like: ('select * from user where username like ?', ('%' + like + '%',))
-async def find_users(db, like):
-	c = await db.execute(*_find_users(like))
-	return await c.fetchall()
+_get_users_limited = lambda limit, fields: ('select %s from user limit ?' % ', '.join(fields), (limit,))
+async def get_users_limited(db, limit, fields = k_user_fields):
+	return await sql.fetchall(db, _get_users_limited(limit, fields))
+
+_find_users = lambda like, fields: ('select %s from user where username like ?' % ', '.join(fields), ('%' + like + '%',))
+async def find_users(db, like, fields = k_user_fields):
+	return await sql.fetchall(db, _find_users(like, fields))
 
 def _prep_where_matches(where_matches):
 	'''
@@ -55,21 +71,18 @@ def _prep_where_matches(where_matches):
 	wheres = ' and '.join([i + ' = ?' for i in wheres])
 	return wheres, values
 
-async def get_user(db, where_matches):
+async def get_user(db, where_matches, fields = k_user_fields):
 	'''
 	See _prep_where_matches() for `where_matches` spec
 	'''
 	wheres, values = _prep_where_matches(where_matches)
-	c = await db.execute('select * from user where ' + wheres, values)
-	return await c.fetchall()
+	return await sql.fetchall(db, ('select %s from user where ' % ', '.join(fields) + wheres, values))
 
 
 async def authenticate(db, username, password):
-	c = await db.execute('select * from user where username = ?', (username,))
-	user = await c.fetchone()
+	user = await sql.fetchone(db, ('select id, password, salt from user where username = ?', (username,)))
 	if user and (user['password'] == _hash(password, user['salt'])):
-		c = await db.execute('select role.name as role_name from role join user_role on role.id = user_role.role join user on user.id = user_role.user where user.username = ?', (username,))
-		roles = await c.fetchall()
+		roles = await sql.fetchall(db, ('select role.name as role_name from role join user_role on role.id = user_role.role join user on user.id = user_role.user where user.username = ?', (username,)))
 		return user['id'], [role['role_name'] for role in roles]
 	#else:
 	return None, None
@@ -82,20 +95,22 @@ def qt(cls):
 	_question_transactions[cls.__name__] = cls
 	return cls
 
-async def get_handler(class_name, db, user_id):
+async def get_handler(class_name, db, user_id, cycles = None, week_range = None, fields = None):
 	# Construct and return an object of the specified handler class:
-	return await _question_transactions[class_name].create(db, user_id) # TODO: optional args.....
+	return await _question_transactions[class_name].create(db, user_id, week_range = week_range, cycles = cycles, fields = fields) # TODO: more optional args.....
 
 	
 class Question_Transaction: # Abstract base class; see actual functional implementations below
 	table = None
+	table_fields = ('id',) # the fields the transaction itself needs (beyond those its renderer declares; see html.fields())
 	
-	def __init__(self, db, user_id, week_range = None, answer_option_count = 5):
+	def __init__(self, db, user_id, week_range = None, answer_option_count = 5, cycles = None, fields = None):
 		self._db = db
 		self._user_id = user_id
 		self._week_range = week_range # constrain to records only within week_range; expected to be two-tuple of week numbers, as integers, like (3, 10) for weeks 3-10
-		self._cycles = None
+		self._cycles = cycles # constrain to records only within these cycles, e.g., (0, 2); see cw_index.py
 		self._answer_option_count = answer_option_count
+		self._fields = tuple(dict.fromkeys(self.table_fields + tuple(fields))) if fields else None # the renderer's fields, plus our own (unique, in order); None: all
 		# Subclasses expected to set self._question and self._options here
 
 	@property
@@ -114,6 +129,10 @@ class Question_Transaction: # Abstract base class; see actual functional impleme
 	def cycles(self):
 		return self._cycles
 
+	@property
+	def fields(self):
+		return self._fields # see sql._columns()
+
 	@property
 	def question(self):
 		return self._question
@@ -131,23 +150,26 @@ class Question_Transaction: # Abstract base class; see actual functional impleme
 		return self._answer_option_count
 
 	def log_user_answer(self, answer_id):
-		raise Exception("Must be implemented by subclass")
+		l.debug('%s.log_user_answer(%s)' % (type(self).__name__, answer_id))
+		if self._user_id is None or not self._question:
+			return
+		answer_log.add(self._user_id, self.table, self._question['id'], answer_id, answer_id == self._answer_id)
 
 
 class Basic_Grammar_QT(Question_Transaction):
 	@classmethod # need to use factory pattern creation scheme b/c can't await in __init__
-	async def create(cls, db, user_id, week_range = None):
-		self = cls(db, user_id, week_range)
+	async def create(cls, db, user_id, week_range = None, cycles = None, fields = None):
+		self = cls(db, user_id, week_range, cycles = cycles, fields = fields)
 		self._question = await sql.fetchone(db, sql.get_random_records(self, 1))
+		if not self._question: # nothing to ask about, within the chosen cycles/weeks
+			self._options, self._answer_id = [], None
+			return self
 		self._options = await sql.fetchall(db, sql.get_random_records(self, self.answer_option_count - 1, [self._question['id'],]))
 		self._options.append(self._question)
 		shuffle(self._options)
 		self._answer_id = self._question['id']
 		return self
 
-	def log_user_answer(self, answer_id):
-		l.debug('Basic_Grammar_QT.log_user_answer(%s)' % answer_id)
-
 
 @qt
 class English_Vocabulary_QT(Basic_Grammar_QT):
@@ -168,11 +190,15 @@ class Science_Grammar_QT(Basic_Grammar_QT):
 @qt
 class History_Sequence_QT(Question_Transaction):
 	table = 'event'
+	table_fields = ('id', 'name', 'keywords', 'start', 'fake_start_date') # see sql.get_surrounding_event_records()
 	@classmethod # need to use factory pattern creation scheme b/c can't await in __init__
-	async def create(cls, db, user_id, week_range = None, date_range = None):
-		self = History_Sequence_QT(db, user_id, week_range)
+	async def create(cls, db, user_id, week_range = None, date_range = None, cycles = None, fields = None):
+		self = History_Sequence_QT(db, user_id, week_range, cycles = cycles, fields = fields)
 		self._date_range = date_range # constrain to history events only within date_range; expected to be two-tuple of years, as integers, like (1500, 1750); BC dates are simply negative integers
 		self._question = await sql.fetchone(db, sql.get_random_event_records(self, 1))
+		if not self._question: # nothing to ask about, within the chosen cycles/weeks
+			self._options, self._answer_id = [], None
+			return self
 		self._options, self._answer_id = await sql.get_surrounding_event_records(self, self.answer_option_count, self._question)
 		return self
 
@@ -184,18 +210,109 @@ class History_Sequence_QT(Question_Transaction):
 	def date_range(self):
 		return self._date_range
 
-	def log_user_answer(self, answer_id):
-		l.debug('History_Sequence_QT.log_user_answer(%s)' % answer_id)
-
 # TODO!!!
 # db.execute('insert into test_event_sequence_target (user, event, correct_option) values (?, ?, ?)', (user_id, event_id, correct_event_id)
 # db.executemany('insert into test_event_sequence_incorrect_option (target, incorrect_option
 
+# -----------------------------------------------------------------------------
+# Answers and progress
+
+class Answer_Log:
+	'''
+	Answers are queued by Question_Transaction.log_user_answer(), and written in batches
+	(every settings.k_answer_batch_size answers, or every settings.k_answer_flush_interval
+	seconds; see main._flush_answers()), each batch in one transaction, together with its
+	updates to the `progress` rollup (see schema/user/0003_answers.sql), so the rollup
+	never disagrees with the log.  The writes go through the main connection: a commit from
+	any other connection would change its `pragma data_version`, which stands for "someone
+	else changed the db" (see result_cache.py, resource_bundles.py, the /resources ETag).
+	Other work on the connection may run within the transaction; reads are none the worse,
+	and the rest - add_user()'s inserts, and main's attaching and swapping of the content db
+	(executescript() commits any open transaction) - wait on the same lock (`writing`).
+	'''
+	def __init__(self):
+		self.db = None # until open()
+		self.pending = [] # [(user, subject, record, chosen, correct, answered), ...]
+
+	def open(self, db):
+		self.db = db # (the rollup's cycle/week come from cw_index, so the user db alone will do)
+
+	def add(self, user_id, subject, record_id, chosen, correct):
+		self.pending.append((user_id, subject, record_id, chosen, int(correct), time.time()))
+		if self.db and len(self.pending) == settings.k_answer_batch_size:
+			asyncio.ensure_future(self.flush())
+
+	async def flush(self):
+		'''
+		Write out all pending answers; returns the number written.
+		'''
+		async with writing: # (also one flush at a time)
+			batch, self.pending = self.pending, []
+			if not batch or not self.db:
+				self.pending[:0] = batch
+				return 0
+			start = time.perf_counter()
+			progress = []
+			for user, subject, record, chosen, correct, answered in batch:
+				cell = cw_index.cell(subject, record)
+				if cell: # (else, a record with no cycle/week; logged, but not rolled up)
+					progress.append((user, subject) + cell + (correct, answered, correct))
+			try:
+				async with admission.slot():
+					await self.db.execute('begin immediate')
+					for statement, rows in ((k_answer_insert, batch), (k_progress_upsert, progress)):
+						written = time.perf_counter()
+						await self.db.executemany(statement, rows)
+						slowlog.check(written, (statement,), len(rows)) # (the rows' count, not the rows themselves, in the log)
+					written = time.perf_counter()
+					await self.db.execute('commit')
+					slowlog.check(written, ('commit',), 0)
+			except Exception as e: # (including admission.Shed, under load)
+				try:
+					await self.db.execute('rollback')
+				except OperationalError:
+					pass # (sqlite had already rolled back, or never began)
+				self.pending[:0] = batch # (try again next time)
+				l.error('Exception (%s: %s) writing %d answers; will retry' % (str(e), type(e), len(batch)))
+				return 0
+			metrics.inc('answers.logged', len(batch))
+			metrics.observe('answers.flush', time.perf_counter() - start)
+			return len(batch)
+
+	async def close(self):
+		if self.db:
+			await self.flush()
+			self.db = None # (the connection is the app's to close)
+
+k_answer_insert = 'insert into answer (user, subject, record, chosen, correct, answered) values (?, ?, ?, ?, ?, ?)'
+k_progress_upsert = '''insert into progress (user, subject, cycle, week, attempts, correct, last_seen, streak) values (?, ?, ?, ?, 1, ?, ?, ?)
+	on conflict (user, subject, cycle, week) do update set attempts = attempts + 1, correct = correct + excluded.correct, last_seen = excluded.last_seen, streak = case when excluded.correct then streak + 1 else 0 end'''
+
+answer_log = Answer_Log() # this process's; opened by main._init()
+
+writing = asyncio.Lock() # held by each write (or executescript()) on the main connection, so that one's transaction can't take in - or be committed by - another's statements
+
+async def get_progress(db, user_id, subject = None):
+	'''
+	A student's dashboard: one row per subject (question table; e.g., 'science', 'event'),
+	cycle and week answered, with attempts, correct, last_seen (a timestamp) and streak;
+	in one primary-key range lookup on the rollup.  (Answers not yet flushed aren't counted.)
+	'''
+	if subject:
+		return await sql.fetchall(db, ('select subject, cycle, week, attempts, correct, last_seen, streak from progress where user = ? and subject = ? order by cycle, week', (user_id, subject)))
+	return await sql.fetchall(db, ('select subject, cycle, week, attempts, correct, last_seen, streak from progress where user = ? order by subject, cycle, week', (user_id,)))
+
 # -----------------------------------------------------------------------------
 # Resource handlers
 
-async def get_resources(spec):
-	return await sql.get_resources(spec)
+async def get_resources(spec, fields = None):
+	return await sql.get_resources(spec, fields)
+
+def refines(previous, search_string):
+	return sql.refines(previous, search_string)
+
+def refine_resources(results, search_string):
+	return sql.refine_resources(results, search_string)
 
 
 # -----------------------------------------------------------------------------
@@ -203,3 +320,50 @@ async def get_resources(spec):
 
 async def get_contexts(dbc):
 	return await sql.get_contexts(dbc)
+
+async def get_data_version(dbc):
+	'''
+	Changes whenever another connection (e.g., an admin at the sqlite3 prompt) has committed
+	changes to the (main) database since this connection last looked.  Note that the
+	(immutable) content db, if any, only changes by swapping; see main.publish_content_db().
+	'''
+	return (await sql.fetchone(dbc, ('pragma data_version', []), coalesce = True))[0]
+
+
+# -----------------------------------------------------------------------------
+# Warm-up
+
+k_hot_tables = ('cycle_week', 'event', 'history', 'science', 'vocabulary', 'english', 'latin_vocabulary',
+	'context', 'subject', 'resource', 'resource_use', 'resource_instance', 'resource_type', 'resource_source',
+	'user', 'role', 'user_role')
+
+async def warm_up(db, fields = None):
+	'''
+	Pull the hot tables into the page cache, prepare the question-transaction statements
+	by running each one once, and refresh the query planner's statistics.
+	`fields`, {class_name: renderer fields}, as get_handler() will be given them, so that
+	the statements prepared are the ones that will be used.
+	Returns a dict of {class_name: transaction} so that the caller may warm up the
+	html rendering of each transaction's question, too.
+	'''
+	for table in k_hot_tables:
+		try:
+			await sql.fetchall(db, (f'select * from {table}', []))
+		except OperationalError as e:
+			l.warning('warm-up could not read table "%s" (%s)' % (table, e))
+
+	transactions = dict()
+	for name, cls in _question_transactions.items():
+		try:
+			transactions[name] = await cls.create(db, None, fields = (fields or {}).get(name))
+		except Exception as e: # e.g., an empty table leaves nothing to ask about; not fatal
+			l.warning('warm-up could not create %s (%s: %s)' % (name, type(e).__name__, e))
+
+	for schema in await sql.fetchall(db, ('pragma database_list', [])):
+		for statement in ('analyze "%s"', 'pragma "%s".optimize'):
+			try:
+				await sql.fetchall(db, (statement % schema['name'], []))
+			except OperationalError as e: # e.g., the read-only (immutable) content db can't store statistics; that's analyzed before publishing, instead
+				l.debug('warm-up skipped "%s" (%s)' % (statement % schema['name'], e))
+
+	return transactions
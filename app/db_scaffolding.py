@@ -47,29 +47,233 @@ for that matter.  The main expectation is that the function wrapped in run() wil
 because the db object has to be created within Test_Loop(), as initialization of the aiosqlite DB is also an async operation, so it
 has to happen in the run(), or within the event loop, anyway.
 
+If your curriculum content lives in its own read-only database (settings.k_content_db_filename),
+the test loop ATTACHes it just as the server does; or name the files explicitly:
+
+	>>> tl = dbs.Test_Loop('ohs-user.db', 'ohs-content.db')
+
 You may want to explicitly delete tl, your test-loop object, because the __del__ will close() the asyncio loop properly.
 
+Benchmarking
+------------
+
+The same calls can be timed.  bench() runs the function `warm_up` times untimed (cold page
+cache, statement preparation...), then `n` times timed, and returns a report (times in ms):
+
+	>>> tl.bench(sql.foo, arg1, arg2, n = 200)
+	{'name': 'sql.foo', 'db': 'ohs-test.db', 'n': 200, 'min': 0.41, 'median': 0.45, 'p95': 0.61, 'max': 1.9, 'rows': 12}
+
+`rows` is the length of the (list) result, or, for a list of (name, records) pairs, like
+sql.get_resources()', the total.  Pass `profile = 'foo.pstats'` to cProfile the timed runs,
+too; note that sqlite itself runs in aiosqlite's thread, so the profile shows the Python
+side (building statements, handling rows), and sqlite's time only as waiting.
+
+To compare two implementations, or two databases (e.g., before and after an index), side by side:
+
+	>>> dbs.compare([(tl, sql.foo), (tl, sql.foo2)], arg1, arg2)
+	>>> dbs.compare([(tl, sql.foo), (dbs.Test_Loop('ohs-indexed.db'), sql.foo)], arg1, arg2)
+
+(Test loops use their dbs as they are - pending migrations aren't applied, so a "before" db
+stays before - unless made with `migrate = True`, or, from the command line, --migrate.)
+
+Every call runs its statements: the result cache (result_cache.py) and single-flight reads
+(single_flight.py) are off within a test loop, or else every timed run after the first would
+time a cache lookup.  To time the server's cached path instead, make it with `cache = True`
+(--cache).
+
+Or, from the command line (arguments are Python literals; --spec makes the first argument a
+spec, as plan_audit.Spec, for the functions that take one):
+
+	$ python -m app.db_scaffolding db.find_users "'a'"
+	$ python -m app.db_scaffolding sql.get_resources --spec "table='science', week_range=(1, 28)" --vs-db ohs-indexed.db --json
+	$ python -m app.db_scaffolding sql.get_contexts -n 1000 --profile contexts.pstats
+
 '''
 
+import argparse
+import ast
 import asyncio
+import contextlib
+import cProfile
+import importlib
+import json
+import sys
+import time
+
 import aiosqlite
 
 from . import main
+from . import metrics
+from . import settings
 
 class Test_Loop:
 	
-	def __init__(self):
+	def __init__(self, filename = settings.k_db_filename, content_filename = settings.k_content_db_filename, in_memory = False, migrate = False, cache = False):
+		'''
+		`filename` and `content_filename` default to the server's own settings; pass a
+		`content_filename` to work against a split user/content layout (see main.init_db()),
+		and `in_memory` to serve that content from an in-memory snapshot.  The db is used as it
+		is (so that, e.g., a "before" db keeps its older schema) unless `migrate`.  Statements
+		bypass the result cache and single-flight unless `cache`.
+		'''
 		self.loop = asyncio.new_event_loop()
 		self.db = None
+		self.filename = filename
+		self.content_filename = content_filename
+		self.in_memory = in_memory
+		self.migrate = migrate
+		self.cache = cache
 
 	def __del__(self):
 		self.loop.close()
 
 	async def wrap(self, func, *args, **kwargs):
 		if not self.db:
-			self.db = await main.init_db('ohs-test.db')
-		return await func(self.db, *args, **kwargs)
+			self.db = await main.init_db(self.filename, self.content_filename, migrate = self.migrate, in_memory = self.in_memory)
+		with _caching(self.cache):
+			return await func(self.db, *args, **kwargs)
 
 	def run(self, func, *args, **kwargs):
 		return self.loop.run_until_complete(self.wrap(func, *args, **kwargs))
 
+	def bench(self, func, *args, n = 100, warm_up = 5, profile = None, **kwargs):
+		'''
+		Time `func` (as run() calls it) `n` times, after `warm_up` untimed calls; returns a
+		report dict (see module doc).  `profile`: a filename for cProfile stats of the timed calls.
+		'''
+		return self.loop.run_until_complete(self._bench(func, args, kwargs, n, warm_up, profile))
+
+	def close(self):
+		if self.db:
+			self.loop.run_until_complete(self.db.close())
+			self.db = None
+
+	async def _bench(self, func, args, kwargs, n, warm_up, profile):
+		for i in range(warm_up):
+			result = await self.wrap(func, *args, **kwargs)
+		profiler = cProfile.Profile() if profile else None
+		times = []
+		for i in range(n):
+			if profiler:
+				profiler.enable()
+			start = time.perf_counter()
+			result = await self.wrap(func, *args, **kwargs)
+			times.append((time.perf_counter() - start) * 1000)
+			if profiler:
+				profiler.disable()
+		if profiler:
+			profiler.dump_stats(profile)
+		p = metrics.percentiles(times)
+		report = {'name': _name(func), 'db': self.filename, 'n': n, 'min': min(times), 'median': p['p50'], 'p95': p['p95'], 'max': p['max'], 'rows': _rows(result)}
+		if self.content_filename:
+			report['content_db'] = self.content_filename + (' (in memory)' if self.in_memory else '')
+		if profile:
+			report['profile'] = profile
+		return report
+
+
+def compare(candidates, *args, n = 100, warm_up = 5, out = sys.stdout, **kwargs):
+	'''
+	bench() each (Test_Loop, func) in `candidates` with the same arguments; print a table to
+	`out` (unless None), the first candidate being the baseline, and return the reports.
+	'''
+	reports = [test_loop.bench(func, *args, n = n, warm_up = warm_up, **kwargs) for test_loop, func in candidates]
+	if out:
+		_table(reports, out)
+	return reports
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+@contextlib.contextmanager
+def _caching(on):
+	# Off: no result cache and no single-flight, for the duration of a call (both read their settings per call)
+	if on:
+		yield
+		return
+	saved = settings.k_result_cache_bytes, settings.k_single_flight
+	settings.k_result_cache_bytes, settings.k_single_flight = 0, False
+	try:
+		yield
+	finally:
+		settings.k_result_cache_bytes, settings.k_single_flight = saved
+
+def _table(reports, out):
+	out.write('%-44s %9s %9s %9s %9s %7s %6s\n' % ('(ms)', 'min', 'median', 'p95', 'max', 'rows', 'x'))
+	for report in reports:
+		label = '%s @ %s' % (report['name'], report['db'])
+		out.write('%-44s %9.3f %9.3f %9.3f %9.3f %7s %6.2f\n' % (label[-44:], report['min'], report['median'], report['p95'], report['max'], report['rows'], report['median'] / reports[0]['median']))
+
+def _name(func):
+	return '%s.%s' % (func.__module__.rpartition('.')[2], func.__qualname__)
+
+def _rows(result):
+	if not isinstance(result, list):
+		return None
+	if result and all([isinstance(item, tuple) and len(item) == 2 and isinstance(item[1], list) for item in result]):
+		return sum([len(records) for name, records in result]) # e.g., sql.get_resources()'s [(subject, records), ...]
+	return len(result)
+
+def _target(name):
+	module, _, function = name.rpartition('.')
+	return getattr(importlib.import_module('.' + module, __package__), function)
+
+def _literal(arg):
+	try:
+		return ast.literal_eval(arg)
+	except (ValueError, SyntaxError): # a bare word; take it as a string
+		return arg
+
+def _keywords(text):
+	# "table='science', cycles=(0, 1)" -> {'table': 'science', 'cycles': (0, 1)}
+	call = ast.parse('f(%s)' % text, mode = 'eval').body
+	return dict([(keyword.arg, ast.literal_eval(keyword.value)) for keyword in call.keywords])
+
+def _spec_caller(func, spec_kwargs):
+	from .plan_audit import Spec # (here, not at top; plan_audit imports main, as we do, but is otherwise unneeded)
+	async def call(db, *args):
+		return await func(Spec(db, **spec_kwargs), *args)
+	call.__module__, call.__qualname__ = func.__module__, func.__qualname__
+	return call
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Benchmark a sql.py / db.py coroutine (called as func(db, *args), or func(spec, *args) with --spec)')
+	parser.add_argument('target', help = 'e.g., sql.get_contexts or db.find_users')
+	parser.add_argument('args', nargs = '*', help = 'Python literals (bare words are strings)')
+	parser.add_argument('--db', default = settings.k_db_filename)
+	parser.add_argument('--content-db', default = settings.k_content_db_filename)
+	parser.add_argument('--spec', help = 'plan_audit.Spec keyword arguments, e.g., "table=\'science\', cycles=(0, 1)"')
+	parser.add_argument('--vs', help = 'another implementation to compare, e.g., sql.get_resources2')
+	parser.add_argument('--vs-db', help = 'another db to compare (the same target)')
+	parser.add_argument('--vs-content-db')
+	parser.add_argument('-n', type = int, default = 100, help = 'timed calls')
+	parser.add_argument('--warm-up', type = int, default = 5, help = 'untimed calls first')
+	parser.add_argument('--profile', help = 'write cProfile stats of the (first candidate\'s) timed calls here')
+	parser.add_argument('--json', action = 'store_true', help = 'print the reports as JSON, rather than a table')
+	parser.add_argument('--migrate', action = 'store_true', help = 'apply pending schema migrations to the dbs first (default: bench them as they are)')
+	parser.add_argument('--cache', action = 'store_true', help = 'leave the result cache and single-flight on (default: every call runs its statements)')
+	a = parser.parse_args()
+	import logging
+	logging.getLogger().setLevel(logging.WARNING) # (main sets DEBUG; this is a report)
+
+	def target(name):
+		func = _target(name)
+		return _spec_caller(func, _keywords(a.spec)) if a.spec else func
+	test_loop = Test_Loop(a.db, a.content_db, migrate = a.migrate, cache = a.cache)
+	candidates = [(test_loop, target(a.target))]
+	if a.vs:
+		candidates.append((test_loop, target(a.vs)))
+	if a.vs_db:
+		candidates.append((Test_Loop(a.vs_db, a.vs_content_db, migrate = a.migrate, cache = a.cache), target(a.target)))
+	args = [_literal(arg) for arg in a.args]
+	reports = [candidates[0][0].bench(candidates[0][1], *args, n = a.n, warm_up = a.warm_up, profile = a.profile)]
+	reports += compare(candidates[1:], *args, n = a.n, warm_up = a.warm_up, out = None)
+	if a.json:
+		print(json.dumps(reports, indent = '\t'))
+	else:
+		_table(reports, sys.stdout)
+	for test_loop in set([test_loop for test_loop, func in candidates]):
+		test_loop.close()
+
@@ -4,6 +4,7 @@ __version__ = '0.1'
 __license__ = 'MIT'
 
 import functools
+import hashlib
 import logging
 l = logging.getLogger(__name__)
 
@@ -13,6 +14,21 @@ from dominate.util import raw
 
 from . import valid
 from . import settings
+from . import static
+
+# Changes whenever this module (i.e., any template) does; see main.hrc() for its use in ETags:
+with open(__file__, 'rb') as f:
+	template_version = hashlib.sha1(f.read()).hexdigest()[:12]
+
+def fields(*names):
+	'''
+	Declare the record fields that a renderer uses, so that queries can select just those
+	(see db.Question_Transaction, sql.get_resources() and main.py, which pass them along).
+	'''
+	def decorator(func):
+		func.fields = names
+		return func
+	return decorator
 
 # Classes ---------------------------------------------------------------------
 
@@ -105,6 +121,7 @@ def select_user(url):
 	return d.render()
 
 
+@fields('id', 'username')
 def filter_user_list(results, url): # TODO: GENERALIZE for other lists!
 	table = t.table()
 	with table:
@@ -131,15 +148,17 @@ def quiz(ws_url, db_handler, html_function):
 				('English vocabulary', _gurl(settings.k_english_vocabulary)),
 				('English grammar', _gurl(settings.k_english_grammar)),
 				('Latin vocabulary', _gurl(settings.k_latin_vocabulary))), True, 'Subjects...')
-			_dropdown(t.div(cls = 'dropdown'), 'cycle_dropdown', (
-				('Cycle 1', 'bogus'),
-				('Cycle 2', 'bogus'),
-				('Cycle 3', 'bogus'),
-				('All Cycles', 'bogus'),
-				('My Cycle', 'bogus')), True, 'Cycles...')
+			_dropdown(t.div(cls = 'dropdown'), 'cycle_dropdown', ( # (options sent via websocket; see main._quiz())
+				('Cycle 1', '1'),
+				('Cycle 2', '2'),
+				('Cycle 3', '3'),
+				('All Cycles', 'all')), False, 'Cycles...') # TODO: 'My Cycle', once users have one
 			_dropdown(t.div(cls = 'dropdown'), 'weeks_dropdown', (
-				('...', 'bogus'),
-				('All Weeks', 'bogus')), True, 'Weeks...')
+				('Weeks 1-6', '1-6'),
+				('Weeks 7-12', '7-12'),
+				('Weeks 13-18', '13-18'),
+				('Weeks 19-24', '19-24'),
+				('All Weeks', 'all')), False, 'Weeks...')
 			_dropdown(t.div(cls = 'dropdown'), 'difficulty_dropdown', (
 				('Easy', 'bogus'),
 				('Medium', 'bogus'),
@@ -150,6 +169,9 @@ def quiz(ws_url, db_handler, html_function):
 		t.script(_js_dropdown())
 	return d.render()
 
+def no_quiz_question():
+	return t.div(t.p('There are no questions within the chosen cycles and weeks; try choosing more.'), cls = 'quiz_content').render()
+
 def resources(url, filters, qargs): # TODO: this is basically identical to select_user (and presumably other search-driven pages whose content comes via websocket); consolidate!
 	d = _doc('Resources')
 	with d:
@@ -173,7 +195,7 @@ def resources(url, filters, qargs): # TODO: this is basically identical to selec
 				with t.tr():
 					t.td(_text_input('search', None, ('autofocus',), {'autocomplete': 'off', 'oninput': 'search(this.value)'}, 'Search', type_ = 'search'), style = 'width: 87%', colspan = 6)
 					_dropdown(t.td(style = 'width:10%', cls = 'dropdown'), 'cycle_dropdown', (
-						('Any Cycle', 'bogus'), ('Cycle 1', 'bogus'), ('Cycle 2', 'bogus'), ('Cycle 3', 'bogus')), False)
+						('Any Cycle', 'all'), ('Cycle 1', '1'), ('Cycle 2', '2'), ('Cycle 3', '3')), False, 'Cycle 1') # (default; see main.Resource_Spec)
 					with t.td(style = 'width:20%'):
 						t.input(type = 'number', placeholder = 'first wk', id = 'first_week_selector', min='1', max='28', oninput = 'filter_first_week(this.value)')
 						t.br()
@@ -224,6 +246,7 @@ def _resources(container, records, show_cw, subject_title, subject_directory, ad
 
 	
 @subject_resource('science')
+@fields('cycle', 'week', 'prompt', 'answer')
 def science_resources(container, records, show_cw):
 	def add_record(record, div): # callback function, see _resources()
 		div += t.div(t.b(record['prompt']))
@@ -233,6 +256,7 @@ def science_resources(container, records, show_cw):
 
 
 @subject_resource('english_vocabulary')
+@fields('cycle', 'week', 'word', 'definition')
 def english_vocabulary_resources(container, records, show_cw):
 	def add_record(record, div): # callback function, see _resources()
 		div += t.div(t.b(record['word']), ' = ', cls = 'pair')
@@ -242,6 +266,7 @@ def english_vocabulary_resources(container, records, show_cw):
 
 
 @subject_resource('latin_vocabulary')
+@fields('cycle', 'week', 'word', 'translation')
 def english_vocabulary_resources(container, records, show_cw):
 	def add_record(record, div): # callback function, see _resources()
 		div += t.div(t.b(record['word']), ' = ', cls = 'pair')
@@ -250,6 +275,7 @@ def english_vocabulary_resources(container, records, show_cw):
 	_resources(container, records, show_cw, 'Latin', 'latin', add_record, False)
 
 @subject_resource('history')
+@fields('cycle', 'week', 'name', 'primary_sentence')
 def history_resources(container, records, show_cw):
 	def add_record(record, div): # callback function, see _resources()
 		with div:
@@ -261,6 +287,7 @@ def history_resources(container, records, show_cw):
 
 
 @subject_resource('timeline')
+@fields('cycle', 'week', 'name', 'start', 'start_circa', 'end', 'end_circa', 'fake_start_date') # see _event_formatted()
 def event_resources(container, records, show_cw):
 	def add_record(record, div): # callback function, see _resources()
 		div += t.div(_event_formatted(record))
@@ -326,6 +353,10 @@ def resource_list(results, url, show_cw = True):
 		subject_resources[subject](container, records, show_cw)
 	return container.render()
 
+def resource_fields():
+	# {subject: fields} for sql.get_resources(); (external resources' query is already explicit)
+	return dict([(subject, func.fields) for subject, func in subject_resources.items() if hasattr(func, 'fields')])
+
 # -----------------------------------------------------------------------------
 # Question handlers:
 
@@ -335,22 +366,27 @@ def expose(func):
 	return func
 
 @expose
+@fields('prompt', 'answer')
 def multi_choice_english_grammar_question(question, options):
 	return _multi_choice_question(question, options, 'Define or identify', question['prompt'], 'answer')
 
 @expose
+@fields('word', 'definition')
 def multi_choice_english_vocabulary_question(question, options):
 	return _multi_choice_question(question, options, 'What is the definition of', question['word'], 'definition')
 
 @expose
+@fields('word', 'translation')
 def multi_choice_latin_vocabulary_question(question, options):
 	return _multi_choice_question(question, options, 'What is the translation for', question['word'], 'translation')
 
 @expose
+@fields('prompt', 'answer')
 def multi_choice_science_question(question, options):
 	return _multi_choice_question(question, options, 'Define', question['prompt'], 'answer')
 
 @expose
+@fields('id', 'name')
 def multi_choice_history_sequence_question(question, options):
 	d = _start_question('Where does', question['name'], 'belong in this sequence of events?')
 	with d:
@@ -367,16 +403,16 @@ def multi_choice_history_sequence_question(question, options):
 
 _dress_bool_attrs = lambda attrs: dict([(f, True) for f in attrs])
 _gurl = lambda url: settings.k_url_prefix + url # 
-_surl = lambda url: settings.k_static_url + url # static
-_aurl = lambda url: settings.k_static_url + 'audio/' + url # audio
-_lurl = lambda url: settings.k_static_url + 'images/logos/' + url # logos
+_surl = lambda url: static.url(url) # static
+_aurl = lambda url: static.url('audio/' + url) # audio
+_lurl = lambda url: static.url('images/logos/' + url) # logos
 
 
 def _doc(title, css = None, scripts = None):
 	d = document(title = title)
 	with d.head:
 		t.meta(name = 'viewport', content = 'width=device-width, initial-scale=1')
-		t.link(href = settings.k_static_url + 'css/main.css', rel = 'stylesheet')
+		t.link(href = _surl('css/main.css'), rel = 'stylesheet')
 	return d
 
 def _error(error):
@@ -525,6 +561,7 @@ def _js_socket_quiz_manager(url, db_handler, html_function):
 	var ws = new WebSocket("%(url)s");
 	var check = 0;
 	var go_button = document.getElementById("go");
+	%(resend)s
 
 	ws.onmessage = function(event) {
 		var payload = JSON.parse(event.data);
@@ -532,10 +569,16 @@ def _js_socket_quiz_manager(url, db_handler, html_function):
 			case "start":
 				send_answer(-1); // kick-start
 				break;
+			case "busy":
+				resend(payload.retry);
+				break;
+			case "reconnect":
+				reconnect(payload.delay);
+				break;
 			case "content":
 				document.getElementById("content").innerHTML = payload.content;
 				check = payload.check;
-				go_button.disabled = false;
+				go_button.disabled = (check == null); // null: no question (nothing within chosen cycles/weeks)
 				break;
 		}
 	};
@@ -573,7 +616,7 @@ def _js_socket_quiz_manager(url, db_handler, html_function):
 		setTimeout(function() { send_answer(selected.value); }, show_answer_delay);
 
 	};
-	''' % {'url': url, 'db_handler': db_handler, 'html_function': html_function})
+	''' % {'url': url, 'db_handler': db_handler, 'html_function': html_function, 'resend': _js_resend()})
 
 
 def _js_filter_list(url, selections = None):
@@ -585,6 +628,7 @@ def _js_filter_list(url, selections = None):
 
 	r = raw('''
 	var ws = new WebSocket("%(url)s");
+	%(resend)s
 	ws.onmessage = function(event) {
 		var payload = JSON.parse(event.data);
 		switch(payload.call) {
@@ -592,6 +636,12 @@ def _js_filter_list(url, selections = None):
 				search("");
 				%(filter_call)s
 				break;
+			case "busy":
+				resend(payload.retry);
+				break;
+			case "reconnect":
+				reconnect(payload.delay);
+				break;
 			case "content":
 				document.getElementById("search_result").innerHTML = payload.content;
 				break;
@@ -600,11 +650,26 @@ def _js_filter_list(url, selections = None):
 	function search(str) {
 		ws.send(JSON.stringify({call: "search", string: str}));
 	};
-	''' % {'url': url, 'filter_call': filter_call})
+	''' % {'url': url, 'filter_call': filter_call, 'resend': _js_resend()})
 
 	return r
 
 
+def _js_resend():
+	# Remembers the last message sent on `ws`, so that it can be re-sent (after `delay` ms) when the server sheds load with a "busy" reply (see admission.py)
+	# Also handles the server's "reconnect" hint (see main._shutdown())
+	return '''
+	var last_sent = null;
+	var ws_send = ws.send.bind(ws);
+	ws.send = function(data) { last_sent = data; ws_send(data); };
+	function resend(delay) {
+		setTimeout(function() { if (last_sent != null) { ws.send(last_sent); } }, delay);
+	};
+	function reconnect(delay) { // server is going down; reload (via the reverse proxy, to another server), with jitter so that everybody doesn't at once
+		setTimeout(function() { location.reload(); }, delay * (1 + Math.random()));
+	};
+	'''
+
 def _js_filter_weeks():
 	return raw('''
 	function filter_first_week(week) {
@@ -619,13 +684,26 @@ def _js_check_username(url):
 	# This js not served as a static file for two reasons: 1) it's tiny and single-purpose, and 2) its code is tightly connected to this server code; it's not a candidate for another team to maintain, in other words; it also relies on our URL (for the websocket), whereas true static files might be served by a reverse-proxy server from anywhere, and won't tend to contain any references to the wsgi urls
 	return raw('''
 	var ws = new WebSocket("%(url)s");
+	%(resend)s
 	ws.onmessage = function(event) {
-		document.getElementById("username_exists_message").style.display = ((event.data == 'exists') ? 'block' : 'none');
+		if (event.data == 'exists' || event.data == 'available!') {
+			document.getElementById("username_exists_message").style.display = ((event.data == 'exists') ? 'block' : 'none');
+			return;
+		}
+		var payload = JSON.parse(event.data); // "start", "busy" or "reconnect" - not an answer, so the message stays as it was
+		switch(payload.call) {
+			case "busy":
+				resend(payload.retry);
+				break;
+			case "reconnect":
+				reconnect(payload.delay);
+				break;
+		}
 	};
 	function check_username(username) {
 		ws.send(JSON.stringify({call: "check", string: username}));
 	};
-	''' % {'url': url})
+	''' % {'url': url, 'resend': _js_resend()})
 
 def _js_check_validity():
 	return '''
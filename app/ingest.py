@@ -0,0 +1,426 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Bulk curriculum ingest: load CSV / JSON rows into the content tables (event, history, science,
+vocabulary, cycle_week, resource*...), upserting, so that a new curriculum year (or a
+correction to the current one) needn't be hand-written SQL:
+
+	$ python -m app.ingest data/event.csv data/science.csv data/cycle_week.jsonl
+	$ python -m app.ingest --table resource resources-2021.json
+	$ python -m app.ingest --in-place --db ohs-test.db data/*.csv
+
+The table is named by --table, or else by the file's name ("event.csv" -> event); it must be
+one that schema/content's migrations create (never a user table - user, answer...).  Files are
+.csv (with a header row of column names), .jsonl (one object per line), or .json (an array
+of objects); each is streamed, in batches of settings.k_ingest_batch_size rows, through
+`executemany`.
+
+Rows are keyed by `id`, which other rows refer to (event.cw -> cycle_week.id, history.event ->
+event.id...), so, given an id, a row is inserted or, if it exists, updated - just the columns
+the file has, so a file of (id, note) patches notes.  A few tables have a natural key, too
+(k_natural_keys; e.g., cycle_week's (cycle, week)), so their files may leave ids out.
+
+Values are checked against the column's declared type (integer, boolean, text); invalid rows
+are reported and skipped (or, with --strict, abort the run).  Afterward, references to rows
+that don't exist (a cw with no cycle_week...) are reported, but not removed.
+
+By default, the work is done on a copy of the content db (settings.k_content_db_filename),
+which is then staged (renamed to the content db + settings.k_content_staged_suffix) for the
+running app to publish (POST /admin/reload_content, or by itself, with
+settings.k_content_watch_interval) - so the app keeps serving the old content meanwhile, and
+never waits on the load.  A staged file not yet published is loaded onto, rather than
+replaced, so several runs can build one release.  Since the copy isn't live, it's written
+without a journal, and the loaded tables' indexes are dropped for the load and rebuilt after.
+(Triggers - there are none in schema/content today - are left to fire, as they would for any
+other write.)  Finally, the copy is analyzed, since the app can't analyze the immutable content
+db it attaches (see db.warm_up()).
+
+With --in-place (the single-db layout, or, with --db, building a content db offline - not
+the live content db, which the app opens as immutable), the db is written directly,
+committing each batch, so that other writers wait on at most one batch; indexes stay (a
+running app may be reading them).  POST /admin/reload_content afterward, so
+the app rebuilds what it derives from the content (cw_index, resource bundles...).
+'''
+
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from urllib.request import pathname2url
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import migrate
+from . import settings
+
+k_natural_keys = { # {table: (columns)} - keys to match rows by, for files without ids
+	'cycle_week': ('cycle', 'week'),
+	'context': ('name',),
+	'subject': ('name',),
+	'resource_type': ('name',),
+	'resource_source': ('name',),
+}
+
+k_references = { # {column: table} - for the post-load check for dangling references
+	'cw': 'cycle_week',
+	'event': 'event',
+	'resource': 'resource',
+	'subject': 'subject',
+	'context': 'context',
+	'type': 'resource_type',
+	'source': 'resource_source',
+}
+
+k_reported_errors = 10 # per file; the rest are only counted
+
+k_true = ('1', 'true', 't', 'yes', 'y')
+k_false = ('0', 'false', 'f', 'no', 'n', '')
+
+
+class Invalid(Exception):
+	pass
+
+class Stats:
+	__slots__ = ('path', 'table', 'rows', 'invalid', 'seconds')
+	def __init__(self, path, table):
+		self.path = path
+		self.table = table
+		self.rows = 0
+		self.invalid = 0
+		self.seconds = 0.0
+
+	def __str__(self):
+		return '%s -> %s: %d rows%s in %.3f s (%d rows/s)' % (self.path, self.table, self.rows,
+			' (%d invalid, skipped)' % self.invalid if self.invalid else '', self.seconds, self.rows / self.seconds if self.seconds else 0)
+
+
+def stage(content_filename, paths, table = None, strict = False):
+	'''
+	Load `paths` into a copy of the content db at `content_filename` (or onto an already-staged
+	copy), then stage the result for publishing.  Returns [Stats], one per path.
+	'''
+	staged = content_filename + settings.k_content_staged_suffix
+	work = staged + '.tmp'
+	source = staged if os.path.exists(staged) else content_filename
+	if not os.path.exists(source):
+		raise Invalid('no content db "%s" to load onto; create one first (python -m app.migrate --track content %s)' % (source, content_filename))
+	_copy(source, work)
+	try:
+		db = sqlite3.connect(work, isolation_level = None)
+		try:
+			db.execute('pragma journal_mode = off') # (a throw-away copy until it's staged)
+			db.execute('pragma synchronous = off')
+			tables = set([_table(db, path, table) for path in paths])
+			indexes = _drop_indexes(db, tables)
+			db.execute('begin')
+			results = [ingest(db, path, table, strict, commit_batches = False) for path in paths]
+			start = time.perf_counter()
+			for sql in indexes:
+				db.execute(sql)
+			db.execute('commit')
+			if indexes:
+				l.info('%d indexes rebuilt in %.3f s' % (len(indexes), time.perf_counter() - start))
+			_check_references(db, tables)
+			_analyze(db)
+		finally:
+			db.close()
+		os.replace(work, staged) # (atomic, so the app's watcher never sees a half-written file)
+	except:
+		if os.path.exists(work):
+			os.remove(work)
+		raise
+	l.info('staged "%s"; POST /admin/reload_content to publish it' % staged)
+	return results
+
+def in_place(filename, paths, table = None, strict = False):
+	'''
+	Load `paths` directly into the db at `filename`, a batch per transaction.  Returns [Stats].
+	'''
+	if not os.path.exists(filename): # (rather than have sqlite create an empty one)
+		raise Invalid('no db "%s" to load into' % filename)
+	db = sqlite3.connect(filename, isolation_level = None)
+	try:
+		db.execute('pragma busy_timeout = 5000') # (a running app may be mid-write)
+		results = [ingest(db, path, table, strict) for path in paths]
+		_check_references(db, set([result.table for result in results]))
+		_analyze(db)
+	finally:
+		db.close()
+	return results
+
+def ingest(db, path, table = None, strict = False, commit_batches = True):
+	'''
+	Upsert the rows in `path` into `table` (default: per the filename), on sqlite3 connection
+	`db` (in autocommit mode).  With `commit_batches`, each batch is its own transaction;
+	otherwise, the caller holds one open.  Returns Stats.
+	'''
+	table = _table(db, path, table)
+	stats = Stats(path, table)
+	start = time.perf_counter()
+	types = _column_types(db, table)
+	rows = _read(path)
+	try:
+		where, first = next(rows)
+	except StopIteration:
+		return stats
+	columns = list(first.keys())
+	unknown = [column for column in columns if column not in types]
+	if unknown:
+		raise Invalid('%s: no column(s) %s in table %s' % (path, ', '.join(unknown), table))
+	by_natural_key = 'id' not in columns
+	if by_natural_key:
+		if table not in k_natural_keys:
+			raise Invalid('%s: rows need an id (table %s has no natural key to match rows by)' % (path, table))
+		missing = [column for column in k_natural_keys[table] if column not in columns]
+		if missing:
+			raise Invalid('%s: rows need an id, or the natural key (%s) - missing %s' % (path, ', '.join(k_natural_keys[table]), ', '.join(missing)))
+		columns = ['id'] + columns
+		ids = _natural_key_ids(db, table)
+		keys = [columns.index(column) for column in k_natural_keys[table]]
+	statement = _upsert(table, columns)
+	file_columns = set(first.keys())
+	converters = [(column, _converters.get(types[column], _text), types[column]) for column in columns if column in file_columns]
+	id_index = columns.index('id')
+
+	batch = []
+	def write(batch):
+		if commit_batches:
+			db.execute('begin')
+		db.executemany(statement, batch)
+		if commit_batches:
+			db.execute('commit')
+	def pending():
+		yield where, first
+		yield from rows
+	try:
+		for where, row in pending():
+			try:
+				values = _values(row, file_columns, converters)
+				if by_natural_key:
+					values.insert(0, None)
+				elif values[id_index] is None:
+					raise Invalid('no id')
+			except Invalid as e:
+				stats.invalid += 1
+				if strict:
+					raise Invalid('%s: %s' % (where, e))
+				if stats.invalid <= k_reported_errors:
+					l.warning('%s: %s; skipped' % (where, e))
+				continue
+			if by_natural_key:
+				key = tuple([values[i] for i in keys])
+				values[0] = ids.get(key)
+				if values[0] is None: # a new row; insert now, to learn its id (natural-key tables are small)
+					values[0] = db.execute(statement, values).lastrowid
+					ids[key] = values[0]
+					stats.rows += 1
+					continue
+			batch.append(values)
+			stats.rows += 1
+			if len(batch) >= settings.k_ingest_batch_size:
+				write(batch)
+				batch = []
+		if batch:
+			write(batch)
+	except:
+		if commit_batches and db.in_transaction:
+			db.execute('rollback')
+		raise
+	if stats.invalid > k_reported_errors:
+		l.warning('%s: %d more invalid rows not shown' % (path, stats.invalid - k_reported_errors))
+	stats.seconds = time.perf_counter() - start
+	return stats
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _table(db, path, table):
+	table = table or os.path.basename(path).split('.')[0]
+	if table not in _content_tables():
+		raise Invalid('%s: "%s" is not a content table (%s; name it with --table)' % (path, table, ', '.join(_content_tables())))
+	if table not in _tables(db):
+		raise Invalid('%s: no table "%s" in the db (is its schema up to date? see app/migrate.py)' % (path, table))
+	return table
+
+def _content_tables():
+	# The tables that the content track's migrations create; the only ones ingest will write
+	tables = []
+	for version, path in migrate.migrations('content'):
+		with open(path) as f:
+			tables.extend(_rec_create_table.findall(f.read()))
+	return tables
+
+_rec_create_table = re.compile(r'create table (?:if not exists )?(\w+)', re.IGNORECASE)
+
+def _tables(db):
+	return [row[0] for row in db.execute("select name from sqlite_master where type = 'table' and name not like 'sqlite_%'")]
+
+def _column_types(db, table):
+	return dict([(row[1], row[2].lower()) for row in db.execute('pragma table_info(%s)' % table)])
+
+def _read(path):
+	'''
+	Yield (where, {column: value}) for each row in `path` - where is "path:line", for messages.
+	'''
+	if path.endswith('.csv'):
+		with open(path, newline = '', encoding = 'utf-8') as f:
+			reader = csv.DictReader(f)
+			for row in reader:
+				yield '%s:%d' % (path, reader.line_num), row
+	elif path.endswith('.jsonl'):
+		with open(path, encoding = 'utf-8') as f:
+			for number, line in enumerate(f, 1):
+				if line.strip():
+					yield '%s:%d' % (path, number), json.loads(line)
+	elif path.endswith('.json'):
+		with open(path, encoding = 'utf-8') as f:
+			rows = json.load(f)
+		for number, row in enumerate(rows, 1):
+			yield '%s[%d]' % (path, number), row
+	else:
+		raise Invalid('%s: unknown file type (expected .csv, .jsonl or .json)' % path)
+
+def _values(row, file_columns, converters):
+	if row.keys() != file_columns: # (rather than null missing columns; JSON rows may differ from the first, which set the columns)
+		unexpected, missing = set(row.keys()) - file_columns, file_columns - set(row.keys())
+		raise Invalid('; '.join([problem for problem in (
+			unexpected and 'unexpected column(s) %s' % ', '.join(sorted(map(str, unexpected))),
+			missing and 'missing column(s) %s' % ', '.join(sorted(missing))) if problem]))
+	try:
+		return [convert(row[column]) for column, convert, type in converters]
+	except (ValueError, TypeError): # find the culprit (this is the slow path)
+		for column, convert, type in converters:
+			try:
+				convert(row[column])
+			except (ValueError, TypeError):
+				raise Invalid('%s: %s is not a valid %s' % (column, repr(row[column]), type))
+
+def _integer(value):
+	if type(value) is str:
+		try:
+			return int(value)
+		except ValueError:
+			if value.strip():
+				raise
+			return None
+	if value is None or type(value) is int:
+		return value
+	if type(value) is float and value.is_integer():
+		return int(value)
+	raise ValueError(value)
+
+def _boolean(value):
+	if value is None or type(value) is bool:
+		return value if value is None else int(value)
+	value = str(value).strip().lower()
+	if value in k_true:
+		return 1
+	if value in k_false:
+		return 0
+	raise ValueError(value)
+
+def _text(value):
+	if value is None or type(value) is str:
+		return value
+	if isinstance(value, (dict, list)):
+		raise ValueError(value)
+	return str(value)
+
+_converters = {'integer': _integer, 'boolean': _boolean, 'text': _text} # {declared type: converter}; anything else is taken as text
+
+def _upsert(table, columns):
+	updates = ', '.join(['%s = excluded.%s' % (column, column) for column in columns if column != 'id'])
+	return 'insert into %s (%s) values (%s) on conflict(id) do %s' % (table, ', '.join(columns), ', '.join(['?'] * len(columns)),
+		'update set ' + updates if updates else 'nothing')
+
+def _natural_key_ids(db, table):
+	key = k_natural_keys[table]
+	return dict([(tuple(row[1:]), row[0]) for row in db.execute('select id, %s from %s' % (', '.join(key), table))])
+
+def _drop_indexes(db, tables):
+	'''
+	Drop `tables`' indexes (not the implicit ones, for primary keys and unique constraints,
+	which sqlite won't drop); return the statements to recreate them.
+	'''
+	indexes = db.execute("select name, sql from sqlite_master where type = 'index' and sql is not null and tbl_name in (%s)" % ', '.join(['?'] * len(tables)), tuple(tables)).fetchall()
+	for name, sql in indexes:
+		db.execute('drop index %s' % name)
+	return [sql for name, sql in indexes]
+
+def _check_references(db, tables):
+	existing = _tables(db)
+	for table in sorted(tables):
+		for column in _column_types(db, table):
+			target = k_references.get(column)
+			if target and target in existing and target != table:
+				dangling = db.execute('select count(*) from %s where %s is not null and %s not in (select id from %s)' % (table, column, column, target)).fetchone()[0]
+				if dangling:
+					l.warning('%s: %d rows refer to a %s that does not exist (%s.%s)' % (table, dangling, target, table, column))
+
+def _analyze(db):
+	# Fresh planner statistics (sqlite_stat1) for the loaded tables; the app can't gather them itself
+	# from the content db it attaches (immutable), and, without them, the planner picks scans and
+	# temp sorts (see plan_audit.py)
+	start = time.perf_counter()
+	db.execute('analyze')
+	db.execute('pragma optimize')
+	l.info('analyzed in %.3f s' % (time.perf_counter() - start))
+
+def _copy(source, destination):
+	source = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(source)), uri = True)
+	try:
+		destination = sqlite3.connect(destination)
+		try:
+			source.backup(destination)
+		finally:
+			destination.close()
+	finally:
+		source.close()
+
+
+def run(args):
+	logging.basicConfig(level = logging.INFO, format = '%(message)s')
+	start = time.perf_counter()
+	try:
+		if args.in_place:
+			filename = args.db or (None if settings.k_content_db_filename else settings.k_db_filename)
+			if not filename:
+				print('the app opens the content db as immutable, so it must not change underneath; stage a copy (omit --in-place), or name an offline db with --db')
+				return 1
+			results = in_place(filename, args.paths, args.table, args.strict)
+		else:
+			content_filename = args.content_db or settings.k_content_db_filename
+			if not content_filename:
+				print('no content db (settings.k_content_db_filename or --content-db) to stage a copy of; use --in-place to load straight into a db')
+				return 1
+			results = stage(content_filename, args.paths, args.table, args.strict)
+	except (Invalid, OSError, sqlite3.Error, csv.Error, json.JSONDecodeError) as e:
+		print('ingest failed (nothing written%s): %s' % (' past the last committed batch' if args.in_place else '', e))
+		return 1
+	for result in results:
+		print(result)
+	seconds = time.perf_counter() - start
+	rows = sum([result.rows for result in results])
+	print('%d rows in %.3f s (%d rows/s), in all' % (rows, seconds, rows / seconds if seconds else 0))
+	return 0
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Load curriculum rows (CSV / JSON) into the content tables, upserting')
+	parser.add_argument('paths', nargs = '+', help = '.csv, .jsonl or .json files, each named for its table (or see --table)')
+	parser.add_argument('--table', help = 'load every file into this table')
+	parser.add_argument('--content-db', help = 'content db to stage a loaded copy of (default: settings.k_content_db_filename)')
+	parser.add_argument('--in-place', action = 'store_true', help = 'write directly to the db (--db; default, in the single-db layout, settings.k_db_filename)')
+	parser.add_argument('--db', help = 'with --in-place, the db to write')
+	parser.add_argument('--strict', action = 'store_true', help = 'abort on the first invalid row (default: skip and report it)')
+	sys.exit(run(parser.parse_args()))
@@ -0,0 +1,79 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Event-loop lag monitor.  The whole server is one asyncio loop, so anything that holds it
+(PBKDF2 in db._hash(), rendering a big resource list, a heavy regex...) delays everyone.
+
+monitor() sleeps settings.k_loop_lag_interval at a time and records how late it wakes,
+as the 'loop.lag' histogram (seconds; reported as percentiles at /metrics).  Meanwhile a
+watchdog thread watches monitor()'s heartbeat; when the loop has been held for longer than
+settings.k_loop_lag_threshold, it snapshots the loop thread's stack (sys._current_frames())
+and logs it, so the culprit is named while it's still running.  Stalls are counted as
+'loop.stalls'.
+'''
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import metrics
+from . import settings
+
+k_stack_depth = 12 # innermost frames logged per stall
+
+_beat = None # time.monotonic() of monitor()'s latest wake-up
+_loop_thread = None # ident of the thread running the loop
+_stop = threading.Event()
+
+async def monitor():
+	global _beat
+	interval = settings.k_loop_lag_interval
+	while True:
+		start = time.monotonic()
+		_beat = start
+		await asyncio.sleep(interval)
+		lag = max(0, time.monotonic() - start - interval)
+		metrics.observe('loop.lag', lag)
+		if lag > settings.k_loop_lag_threshold:
+			l.warning('event loop was held for %.3f seconds' % lag)
+
+def start():
+	'''
+	Start monitoring the running loop; returns the monitor task (see stop()).
+	'''
+	global _loop_thread
+	_loop_thread = threading.get_ident()
+	_stop.clear()
+	threading.Thread(target = _watchdog, name = 'loop_watchdog', daemon = True).start()
+	return asyncio.ensure_future(monitor())
+
+def stop(task):
+	_stop.set()
+	task.cancel()
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _watchdog():
+	threshold = settings.k_loop_lag_threshold
+	reported = None # the heartbeat whose stall we've already reported
+	while not _stop.wait(threshold / 2):
+		beat = _beat
+		if beat is None or beat == reported:
+			continue
+		held = time.monotonic() - beat - settings.k_loop_lag_interval
+		if held > threshold:
+			reported = beat
+			metrics.inc('loop.stalls')
+			frame = sys._current_frames().get(_loop_thread)
+			stack = ''.join(traceback.format_stack(frame)[-k_stack_depth:]) if frame else '(no frame)\n'
+			l.warning('event loop held for %.3f seconds (so far); loop thread is at:\n%s' % (held, stack))
@@ -6,12 +6,13 @@ __license__ = 'MIT'
 import aiosqlite
 import asyncio
 import functools
+import hashlib
 import logging
 import re
 import weakref
 import json
+import os
 
-from dataclasses import dataclass
 
 # TODO: These three may be culled once user/session stuff is complete
 import time
@@ -21,7 +22,8 @@ from cryptography import fernet
 from aiohttp import web, WSMsgType, WSCloseCode
 from aiohttp_session import setup as setup_session, get_session
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
-from sqlite3 import IntegrityError
+from sqlite3 import IntegrityError, OperationalError
+from urllib.request import pathname2url
 from yarl import URL
 
 from . import html
@@ -29,6 +31,19 @@ from . import db
 from . import valid
 from . import error
 from . import settings
+from . import static
+from . import metrics
+from . import admission
+from . import cw_index
+from . import migrate as migrate_
+from . import slowlog
+from . import loop_monitor
+from . import profiling
+from . import render
+from . import content_snapshot
+from . import result_cache
+from . import resource_bundles
+from .db import writing as _writing # (`db` is a parameter name in the init functions below)
 
 _debug = True # TODO: parameterize!
 
@@ -45,6 +60,50 @@ gurl = lambda request, name: settings.k_url_prefix + str(request.app.router[name
 r = web.RouteTableDef()
 def hr(text): return web.Response(text = text, content_type = 'text/html')
 
+async def hrc(request, render, *version):
+	'''
+	Conditional html response, with a strong ETag.  `render` is a no-arg function (or
+	coroutine function) returning the page text.  If `version` values are given (e.g., a
+	data version), the ETag derives from those, the URL and the template version, so that
+	a matching If-None-Match gets its 304 without rendering at all; otherwise, the page is
+	rendered and the ETag is a hash of the text.
+	'''
+	etag = None
+	if version:
+		etag = _etag(html.template_version, static.version, request.host, request.path_qs, *version)
+		if _none_match(request, etag):
+			return _not_modified(etag, _page_sizes.get(etag, 0), 'conditional.not_modified_unrendered')
+	text = render()
+	if asyncio.iscoroutine(text):
+		text = await text
+	if not etag:
+		etag = _etag(text)
+	size = len(text.encode('utf-8'))
+	_page_sizes[etag] = size
+	while len(_page_sizes) > k_page_sizes_max:
+		del _page_sizes[next(iter(_page_sizes))] # oldest first (dicts keep insertion order)
+	if _none_match(request, etag):
+		return _not_modified(etag, size, 'conditional.not_modified')
+	response = hr(text)
+	response.headers['ETag'] = etag
+	response.headers['Cache-Control'] = 'no-cache' # i.e., may store, but must revalidate (cheap, now) before re-use
+	metrics.inc('conditional.full_responses')
+	return response
+
+_page_sizes = dict() # {etag: rendered size}, for counting bytes saved by 304s that skip rendering altogether
+k_page_sizes_max = 4096
+
+def _etag(*parts):
+	return '"%s"' % hashlib.sha1('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def _none_match(request, etag):
+	return etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]
+
+def _not_modified(etag, size, counter):
+	metrics.inc(counter)
+	metrics.inc('conditional.bytes_saved', size)
+	return web.Response(status = 304, headers = {'ETag': etag, 'Cache-Control': 'no-cache'})
+
 def auth(roles):
 	'''
 	Checks `roles` against user's roles, if user is logged in.
@@ -78,6 +137,52 @@ def auth(roles):
 	return decorator
 
 
+# Websocket state -------------------------------------------------------------
+# Per-connection state is kept small (__slots__) and defined once, here, rather than
+# as closures and classes created anew within each handler, for every connection.
+
+class Connection: # per-websocket bookkeeping; see _ws_handler() and _reap()
+	__slots__ = ('handler', 'idle_timeout', 'last_active')
+	def __init__(self, handler, idle_timeout):
+		self.handler = handler # e.g., 'ws_quiz_handler'
+		self.idle_timeout = idle_timeout
+		self.last_active = time.monotonic()
+
+class User_List_State:
+	__slots__ = ('db', 'edit_url')
+	def __init__(self, db, edit_url):
+		self.db = db
+		self.edit_url = edit_url
+
+class Quiz_State:
+	__slots__ = ('db', 'session', 'db_handler', 'cycles', 'week_range')
+	def __init__(self, db, session):
+		self.db = db
+		self.session = session
+		self.db_handler = None # new one will be created each transaction
+		self.cycles = None # all (see cycle/weeks dropdowns in html.quiz())
+		self.week_range = None # all
+
+class Resource_Spec: # see sql.get_resources()
+	__slots__ = ('db', 'search_string', 'deep_search', 'cycles', 'week_range', 'context', 'table')
+	def __init__(self, db):
+		self.db = db
+		self.search_string = None
+		self.deep_search = False
+		self.cycles = (0, 1) # default: "cycle 1" ("0" refers to grammar that belongs to "all cycles" (like timeline grammar) - always include "0")
+		self.week_range = (1, 1) # default: "week 1" (only)
+		self.context = 0 # "all"
+		self.table = None # set, per subject, by sql.get_resources()
+
+class Resource_List_State:
+	__slots__ = ('spec', 'url', 'app', 'last')
+	def __init__(self, spec, url, app):
+		self.spec = spec
+		self.url = url
+		self.app = app
+		self.last = None # (filters, search_string, results) of the last search, to refine the next in memory (see _filter_resource_list())
+
+
 # Handlers --------------------------------------------------------------------
 
 @r.get('/login', name = 'login')
@@ -95,6 +200,7 @@ async def login_(request):
 	login_url = gurl(r, 'login')
 	data = await r.post()
 	session = await get_session(r)
+	admission.admit('login')
 	try:
 		# Validate:
 		invalids = []
@@ -112,6 +218,8 @@ async def login_(request):
 			session['user_id'] = user_id
 			session['roles'] = roles
 			# raise web.HTTPFound below, after blanket exception handler...
+	except admission.Shed:
+		raise # see _shed_load()
 	except:
 		return hr(html.login(login_url, error.unknown_login_failure))
 	if 'user_id' in session:
@@ -121,12 +229,13 @@ async def login_(request):
 
 @r.get('/', name = 'home')
 async def home(request):
-	return hr(html.home())
+	return await hrc(request, html.home, 'home')
 
 @r.view('/new_user')
 class New_User(web.View):
 	async def get(self):
-		return hr(html.new_user(html.Form(settings.k_url_prefix + self.request.path), _ws_url(self.request, '/ws_check_username')))
+		r = self.request
+		return await hrc(r, lambda: html.new_user(html.Form(settings.k_url_prefix + r.path), _ws_url(r, '/ws_check_username')), 'new_user')
 	
 	async def post(self):
 		r = self.request
@@ -149,6 +258,7 @@ class New_User(web.View):
 		#else, go on...
 
 		# (Try to) add the user:
+		admission.admit('login')
 		user_id = None
 		try:
 			user_id = await db.add_user(r.app['db'], data['new_username'], data['password'], data['email'])
@@ -164,19 +274,17 @@ class New_User(web.View):
 
 @r.get('/ws_check_username')
 async def ws_check_username(request):
-	dbc = request.app['db']
-	
-	async def msg_handler(payload, ws):
-		assert(payload['call'] == 'check')
-		if payload['string']:
-			value = str(payload['string'])
-			if valid.rec_username.match(value):
-				records = await db.get_user(dbc, (('username', payload['string']),))
-				await ws.send_str('exists' if records else 'available!')
-			else:
-				l.warning('username fragment sent to ws_check_username was not a valid string') # but do nothing else; client code already checks for validity; this must/might be an attack attempt; no need to respond
-
-	return await _ws_handler(request, msg_handler)
+	return await _ws_handler(request, _check_username, 'username_check', request.app['db'])
+
+async def _check_username(dbc, payload, ws):
+	assert(payload['call'] == 'check')
+	if payload['string']:
+		value = str(payload['string'])
+		if valid.rec_username.match(value):
+			records = await db.get_user(dbc, (('username', payload['string']),), ('id',))
+			await ws.send_str('exists' if records else 'available!')
+		else:
+			l.warning('username fragment sent to ws_check_username was not a valid string') # but do nothing else; client code already checks for validity; this must/might be an attack attempt; no need to respond
 	
 
 @r.get('/select_user')
@@ -187,23 +295,20 @@ async def select_user(request):
 
 @r.get('/ws_filter_list')
 async def ws_filter_list(request):
-	edit_url = _http_url(request, '/edit_user')
-	dbc = request.app['db']
-	
-	async def msg_handler(payload, ws):
-		assert(payload['call'] == 'search')
-		records = None
-		if payload['string']:
-			string = str(payload['string'])
-			if valid.rec_string32.match(string):
-				records = await db.find_users(dbc, string)
-			else:
-				l.warning('string fragment sent to ws_filter_list was not a valid string 32-characters or less') # but do nothing else; client code already checks for validity; this must/might be an attack attempt; no need to respond
-		if not records:
-			records = await db.get_users_limited(dbc, 10) # A default list (of 10) to show when nothing is entered into search bar:
-		await ws.send_json({'call': 'content', 'content': html.filter_user_list(records, edit_url)})
-
-	return await _ws_handler(request, msg_handler)
+	return await _ws_handler(request, _filter_user_list, 'admin_list', User_List_State(request.app['db'], _http_url(request, '/edit_user')))
+
+async def _filter_user_list(state, payload, ws):
+	assert(payload['call'] == 'search')
+	records = None
+	if payload['string']:
+		string = str(payload['string'])
+		if valid.rec_string32.match(string):
+			records = await db.find_users(state.db, string, html.filter_user_list.fields)
+		else:
+			l.warning('string fragment sent to ws_filter_list was not a valid string 32-characters or less') # but do nothing else; client code already checks for validity; this must/might be an attack attempt; no need to respond
+	if not records:
+		records = await db.get_users_limited(state.db, 10, html.filter_user_list.fields) # A default list (of 10) to show when nothing is entered into search bar:
+	await ws.send_json({'call': 'content', 'content': html.filter_user_list(records, state.edit_url)})
 
 @r.get('/ws_quiz_handler')
 async def ws_quiz_handler(request):
@@ -213,98 +318,188 @@ async def ws_quiz_handler(request):
 	payload['db_answer_function'] and etc., and the HTML-creation code is in payload['html_function'], and
 	the payload content may be different, but will be what the particular handler function expects.
 	'''
-	r = request
-	session = await get_session(r)
-	dbc = r.app['db']
-	db_handler = None # new one will be created each transaction
-
-	async def msg_handler(payload, ws):
-		nonlocal db_handler
-		if db_handler and 'answer_id' in payload:
-			if payload['answer_id'] >= 0: # -1 indicates "skip"... for now we just allow this and log nothing... TODO: evaluate!
-				db_handler.log_user_answer(payload['answer_id'])
-		if 'db_handler' in payload: # assume that 'html_function' is there, too
-			db_handler = await db.get_handler(payload['db_handler'], dbc, session['user_id']) # TODO: add args; e.g., history might utilize date_range....
-			await ws.send_json({
-				'call': 'content',
-				'content': html.exposed[payload['html_function']](db_handler.question, db_handler.options),
-				'check': db_handler.answer_id})
-		else:
-			l.warning('Unexpected payload for ws_quiz_handler - no db_handler field!')
+	return await _ws_handler(request, _quiz, 'quiz', Quiz_State(request.app['db'], await get_session(request)))
 
-	return await _ws_handler(request, msg_handler)
+async def _quiz(state, payload, ws):
+	if payload.get('call') in ('cycle_dropdown', 'weeks_dropdown'):
+		try:
+			if payload['call'] == 'cycle_dropdown':
+				state.cycles = _cycles_option(payload['option'])
+			else:
+				state.week_range = _weeks_option(payload['option'])
+		except (ValueError, TypeError):
+			l.warning('invalid option sent to ws_quiz_handler::%s' % payload['call'])
+			return
+		await ws.send_json({'call': 'start'}) # client will (re)start with a fresh question, filtered anew (see cw_index.py)
+		return
+	if state.db_handler and 'answer_id' in payload:
+		if payload['answer_id'] >= 0: # -1 indicates "skip"... for now we just allow this and log nothing... TODO: evaluate!
+			state.db_handler.log_user_answer(payload['answer_id'])
+	if 'db_handler' in payload: # assume that 'html_function' is there, too
+		state.db_handler = await db.get_handler(payload['db_handler'], state.db, state.session['user_id'], state.cycles, state.week_range, _renderer_fields(payload['html_function'])) # TODO: add args; e.g., history might utilize date_range....
+		if state.db_handler.question:
+			content = html.exposed[payload['html_function']](state.db_handler.question, state.db_handler.options)
+		else:
+			content = html.no_quiz_question()
+		await ws.send_json({
+			'call': 'content',
+			'content': content,
+			'check': state.db_handler.answer_id})
+	else:
+		l.warning('Unexpected payload for ws_quiz_handler - no db_handler field!')
 
 
 @r.get('/resources')
 async def resources(request):
 	dbc = request.app['db']
 	qargs = request.query
-	filters = (
-		('context', 'choose_context', [(context['name'], context['id']) for context in await db.get_contexts(dbc)]),
-		#('cycle', 'choose_cycle', [(cycle['name'], cycle['id']) for cycle in await db.get_cycles(dbc)]),
-		#('start_week', 'choose_start_week', [(cycle['name'], cycle['id']) for week in await db.get_weeks(dbc)]),
-		#('end_week', 'choose_end_week', [(cycle['name'], cycle['id']) for week in await db.get_weeks(dbc)]),
-	)
+	admission.admit('resource_search')
+
+	async def render():
+		filters = (
+			('context', 'choose_context', [(context['name'], context['id']) for context in await db.get_contexts(dbc)]),
+			#('cycle', 'choose_cycle', [(cycle['name'], cycle['id']) for cycle in await db.get_cycles(dbc)]),
+			#('start_week', 'choose_start_week', [(cycle['name'], cycle['id']) for week in await db.get_weeks(dbc)]),
+			#('end_week', 'choose_end_week', [(cycle['name'], cycle['id']) for week in await db.get_weeks(dbc)]),
+		)
+		return html.resources(_ws_url(request, '/ws_filter_resource_list'), filters, qargs)
 
-	return hr(html.resources(_ws_url(request, '/ws_filter_resource_list'), filters, qargs))
+	# The only dynamic input is the context list, so the content version stands in for it:
+	return await hrc(request, render, request.app['content_generation'], await db.get_data_version(dbc))
 
 
 @r.get('/ws_filter_resource_list') #TODO: this has strong similarities to ws_filter_list (which should be named ws_filter_user_list)
 async def ws_filter_resource_list(request):
-	session = await get_session(request)
 	open_resource = _http_url(request, '/open_resource') #TODO?!??
+	return await _ws_handler(request, _filter_resource_list, 'resource_search', Resource_List_State(Resource_Spec(request.app['db']), open_resource, request.app))
 
-	@dataclass
-	class Spec:
-		db = request.app['db']
-		#user_id = session['user_id']
-		search_string = None
-		deep_search = False
-		cycles = (0, 1) # default: "cycle 1" ("0" refers to grammar that belongs to "all cycles" (like timeline grammar) - always include "0")
-		week_range = (1, 1) # default: "week 1" (only)
-		context = 0 # "all"
-	spec = Spec()
-
-	async def msg_handler(payload, ws):
-		nonlocal spec
-		records = None
-		if payload['call'] == 'search':
-			if payload['string']:
-				search_string = str(payload['string'])
-				if not valid.rec_string32.match(search_string):
-					l.warning('string fragment sent to ws_filter_resource_list was not a valid string 32-characters or less') # but do nothing else; client code already checks for validity; this must/might be an attack attempt; no need to respond
-				else:
-					spec.search_string = search_string # db. call below....
-
-		elif payload['call'] == 'filter_week':
-			# TODO: this is ugly.... let javascript do the work, and just assert(first_week <= last_week here)
-			first_week = last_week = 1
-			if payload['string']:
-				week = int(payload['string']) # TODO: get range rather than just one!
-				if payload['which'] == 'first':
-					first_week = week
-					if last_week < first_week:
-						last_week = first_week
-				else:
-					last_week = week
-					if first_week > last_week:
-						first_week = last_week
-				spec.week_range = (first_week, last_week) # db. call below....
-		elif payload['call'] == 'choose_context':
-			spec.context = int(payload['option']) # db. call below...
-		else:
-			l.warning('unexpected payload["call"] in ws_filter_resource_list::msg_handler()')
+async def _filter_resource_list(state, payload, ws):
+	spec = state.spec
+	records = None
+	if payload['call'] == 'search':
+		if payload['string']:
+			search_string = str(payload['string'])
+			if not valid.rec_string32.match(search_string):
+				l.warning('string fragment sent to ws_filter_resource_list was not a valid string 32-characters or less') # but do nothing else; client code already checks for validity; this must/might be an attack attempt; no need to respond
+			else:
+				spec.search_string = search_string # db. call below....
+
+	elif payload['call'] == 'filter_week':
+		# TODO: this is ugly.... let javascript do the work, and just assert(first_week <= last_week here)
+		first_week, last_week = spec.week_range or (1, 1)
+		if payload['string']:
+			week = int(payload['string']) # TODO: get range rather than just one!
+			if payload['which'] == 'first':
+				first_week = week
+				if last_week < first_week:
+					last_week = first_week
+			else:
+				last_week = week
+				if first_week > last_week:
+					first_week = last_week
+			spec.week_range = (first_week, last_week) # db. call below....
+	elif payload['call'] == 'choose_context':
+		spec.context = int(payload['option']) # db. call below...
+	elif payload['call'] == 'cycle_dropdown':
+		try:
+			spec.cycles = _cycles_option(payload['option']) # db. call below...
+		except ValueError:
+			l.warning('invalid option sent to ws_filter_resource_list::cycle_dropdown')
+	else:
+		l.warning('unexpected payload["call"] in ws_filter_resource_list::msg_handler()')
+
+	# Typing one more character into the search box narrows the last results, so filter those
+	# rather than re-query every subject; re-query when the search broadens or filters change:
+	filters = (spec.cycles, spec.week_range, spec.context, state.app['content_generation'])
+	if state.last and state.last[0] == filters and db.refines(state.last[1], spec.search_string):
+		records = db.refine_resources(state.last[2], spec.search_string)
+		metrics.inc('resource_search.refined')
+	else:
+		records = await db.get_resources(spec, html.resource_fields()) # A default list of this week's resources
+	state.last = (filters, spec.search_string, records)
+
+	await ws.send_json({'call': 'content', 'content': await render.resource_list(records, state.url)}) # TODO: consolidate repetition!
+
+
+@r.get('/health')
+async def health(request):
+	# For the reverse proxy: only route traffic here once warm-up is done (200); 503 until then
+	app = request.app
+	return web.json_response({'ready': app['ready'], 'warm_up_seconds': app.get('warm_up_seconds')}, status = 200 if app['ready'] else 503)
+
+
+@r.get('/metrics')
+@auth('admin')
+async def metrics_(request):
+	return web.json_response(metrics.snapshot())
+
+
+@r.post('/admin/profile')
+@auth('admin')
+async def profile_(request):
+	'''
+	Profile the live process; POST either seconds=N, or handler=<ws handler name>&messages=N
+	(e.g., handler=ws_quiz_handler&messages=200), and optionally cprofile=0 or sample=0 (see
+	profiling.py).  Output files are listed, once written, at GET /admin/profile.
+	'''
+	data = await request.post()
+	handler = data.get('handler')
+	try:
+		seconds = float(data['seconds']) if data.get('seconds') else None
+		messages = int(data['messages']) if data.get('messages') else None
+	except ValueError:
+		raise web.HTTPBadRequest(text = '"seconds" and "messages" must be numbers')
+	if bool(seconds) == bool(handler and messages):
+		raise web.HTTPBadRequest(text = 'Give either "seconds", or "handler" and "messages"')
+	if handler and handler not in [getattr(route.handler, '__name__', None) for route in request.app.router.routes()]:
+		raise web.HTTPBadRequest(text = 'No such handler "%s"' % handler)
+	name = time.strftime('%Y%m%d-%H%M%S') + ('-' + handler if handler else '')
+	try:
+		session = profiling.start(name, seconds, handler, messages, data.get('cprofile') != '0', data.get('sample') != '0')
+	except RuntimeError as e: # one at a time
+		raise web.HTTPConflict(text = str(e))
+	return web.json_response(session.status(), status = 202)
 
-		records = await db.get_resources(spec) # A default list of this week's resources
+@r.get('/admin/profile')
+@auth('admin')
+async def profile_status(request):
+	session = profiling.current()
+	files = sorted(os.listdir(settings.k_profile_dir)) if os.path.isdir(settings.k_profile_dir) else []
+	return web.json_response({'session': session.status() if session else None, 'files': files})
 
-		await ws.send_json({'call': 'content', 'content': html.resource_list(records, open_resource)}) # TODO: consolidate repetition!
+@r.get('/admin/profile/{filename}')
+@auth('admin')
+async def profile_download(request):
+	path = profiling.path(request.match_info['filename'])
+	if not path:
+		raise web.HTTPNotFound()
+	return web.FileResponse(path, headers = {'Content-Disposition': 'attachment; filename="%s"' % os.path.basename(path)})
 
 
-	return await _ws_handler(request, msg_handler)
+@r.post('/admin/reload_content')
+@auth('admin')
+async def reload_content(request):
+	await _reload_content(request.app)
+	return web.Response(text = 'Content reloaded')
 
 
 # Util ------------------------------------------------------------------------
 
+def _cycles_option(option):
+	# 'all', or a cycle number (in which case cycle "0" - grammar belonging to all cycles, like timeline - is included, too)
+	return None if option == 'all' else (0, int(option))
+
+def _renderer_fields(html_function):
+	# The fields an html.exposed question renderer declares (see html.fields()); None (all) if unknown
+	return getattr(html.exposed.get(html_function), 'fields', None)
+
+def _weeks_option(option):
+	# 'all', or a range, like '7-12'
+	if option == 'all':
+		return None
+	first, last = option.split('-')
+	return int(first), int(last)
+
 async def _flash(request):
 	session = await get_session(request)
 	flash = session.get('error_flash')
@@ -321,27 +516,143 @@ def _http_url(request, name):
 	rurl = request.url
 	return URL.build(scheme = settings.k_http, host = request.host, path = settings.k_url_prefix + name)
 
+@web.middleware
+async def _name_handler(request, handler):
+	# For the slow-query log's "handler" field (see slowlog.py); websocket handlers' messages run within this, too
+	route = request.match_info.route
+	slowlog.handler.set(getattr(route.handler, '__name__', None) if route else None)
+	return await handler(request)
+
+@web.middleware
+async def _shed_load(request, handler):
+	try:
+		return await handler(request)
+	except admission.Shed as e:
+		l.warning('%s shed (%s)' % (request.path, type(e).__name__))
+		raise web.HTTPServiceUnavailable(headers = {'Retry-After': str(max(1, settings.k_busy_retry_ms // 1000))})
+
+async def _reap(app):
+	'''
+	Periodically close sockets that have sat idle past their handler's idle timeout (e.g.,
+	tabs left open in a computer lab), and forget any that are already closed but linger,
+	and keep the ws.* gauges current.
+	'''
+	while True:
+		await asyncio.sleep(settings.k_ws_reap_interval)
+		now = time.monotonic()
+		idle = 0
+		for ws, connection in list(app['websockets'].items()):
+			inactivity = now - connection.last_active
+			if ws.closed:
+				app['websockets'].pop(ws, None)
+				metrics.inc('ws.reaped.dead')
+			elif inactivity > connection.idle_timeout:
+				l.debug('reaping %s websocket, idle for %d seconds' % (connection.handler, inactivity))
+				app['websockets'].pop(ws, None)
+				asyncio.ensure_future(ws.close(code = WSCloseCode.GOING_AWAY, message = b'Idle'))
+				metrics.inc('ws.reaped.idle')
+			elif inactivity > settings.k_ws_idle_report:
+				idle += 1
+		metrics.gauge('ws.live', len(app['websockets']))
+		metrics.gauge('ws.idle', idle)
+
+async def _reload_content(app):
+	if settings.k_content_db_filename:
+		await publish_content_db(app['db'], settings.k_content_db_filename)
+	#else, content lives in the main db, already current; just rebuild what's derived from it:
+	await _content_changed(app)
+
+async def _content_changed(app):
+	# Rebuild what's derived from the content, and drop results computed from the old
+	await cw_index.build(app['db'])
+	result_cache.clear() # (after the rebuild, so that nothing cached meanwhile, with the old cw_index's ids, outlives it)
+	await resource_bundles.build(app['db'])
+	app['content_generation'] += 1
+
+async def _watch_content(app):
+	'''
+	Publish a staged content db (see publish_content_db()) once it appears and has stopped
+	changing (i.e., its size and mtime are the same at two checks in a row, so that a slow
+	copy isn't published half-written).  Websockets stay open; their next queries see the new content.
+	'''
+	staged = settings.k_content_db_filename + settings.k_content_staged_suffix
+	seen = None
+	while True:
+		await asyncio.sleep(settings.k_content_watch_interval)
+		try:
+			stat = os.stat(staged)
+		except FileNotFoundError:
+			seen = None
+			continue
+		if (stat.st_size, stat.st_mtime) != seen:
+			seen = (stat.st_size, stat.st_mtime)
+			continue
+		seen = None
+		try:
+			await _reload_content(app)
+			l.info('staged content db "%s" published (generation %d)' % (staged, app['content_generation']))
+		except Exception as e: # keep serving the old content, and keep watching
+			l.error('Exception (%s: %s) publishing staged content db "%s"' % (str(e), type(e), staged))
+
+async def _flush_answers():
+	while True:
+		await asyncio.sleep(settings.k_answer_flush_interval)
+		await db.answer_log.flush() # (failures are logged, and the answers kept for next time)
+
+async def _watch_data_version(app):
+	'''
+	With content in the main db, an admin may edit it directly (e.g., at the sqlite3 prompt);
+	when any other connection has committed, rebuild what's derived from the content, as
+	_reload_content() does (cw_index, result cache, resource bundles, content generation).
+	'''
+	data_version = await db.get_data_version(app['db'])
+	while True:
+		await asyncio.sleep(settings.k_resource_bundle_check_interval)
+		try:
+			current = await db.get_data_version(app['db'])
+			if current != data_version:
+				data_version = current
+				await _content_changed(app)
+		except Exception as e: # (e.g., shed under load); try again next time
+			l.warning('Exception (%s: %s) checking for content changes' % (str(e), type(e)))
+
 def _validate_regex(data, invalids, tuple_list):
 	for field, regex, required in tuple_list:
 		value = str(data[field])
 		if (required and not value) or (value and not regex.match(value)):
 			invalids.append(field)
 
-async def _ws_handler(request, msg_handler):
-	ws = web.WebSocketResponse()
+async def _ws_handler(request, msg_handler, priority, state):
+	'''
+	Calls `msg_handler(state, payload, ws)` for each message received.  `state` is the
+	per-connection state (see "Websocket state", above); `priority` is the admission class
+	(see admission.py) for DB work done by `msg_handler`.
+	'''
+	if request.app.get('draining'):
+		raise web.HTTPServiceUnavailable() # shutting down; the client should reconnect (elsewhere)
+	ws = web.WebSocketResponse(heartbeat = settings.k_ws_heartbeat) # aiohttp pings every k_ws_heartbeat seconds, and closes the socket if no pong comes back
 	await ws.prepare(request)
-	request.app['websockets'].add(ws)
+	handler = request.match_info.route.handler.__name__
+	connection = Connection(handler, settings.k_ws_idle_timeouts.get(handler, settings.k_ws_idle_timeout))
+	request.app['websockets'][ws] = connection
 
 	await ws.send_json({'call': 'start'})
 	l.debug('Websocket prepared, listening for messages...')
 	try:
 		async for msg in ws:
 			try:
+				connection.last_active = time.monotonic()
 				if msg.type == WSMsgType.text:
 					payload = json.loads(msg.data) # Note: payload validated in msg_handler()
 					#l.debug(payload)
-					await msg_handler(payload, ws)
-				elif msg.type == aiohttp.WSMsgType.ERROR:
+					admission.admit(priority) # (each message gets its own deadline)
+					try:
+						with profiling.message(handler): # (no-op unless an admin is profiling this handler; see profile_())
+							await msg_handler(state, payload, ws)
+					except admission.Shed as e: # load-shedding; tell the client to try again shortly, rather than leave it hanging
+						l.warning('%s shed (%s)' % (priority, type(e).__name__))
+						await ws.send_json({'call': 'busy', 'retry': settings.k_busy_retry_ms})
+				elif msg.type == WSMsgType.ERROR:
 					l.warning('websocket connection closed with exception "%s"' % ws.exception())
 				else:
 					l.warning('websocket message of unexpected type "%s" received' % msg.type)
@@ -355,43 +666,207 @@ async def _ws_handler(request, msg_handler):
 		raise
 
 	finally:
-		request.app['websockets'].discard(ws) # in finally block to ensure that this is done even if an exception propagates out of this function
+		request.app['websockets'].pop(ws, None) # in finally block to ensure that this is done even if an exception propagates out of this function
 
 	return ws
 
 
 # Init / Shutdown -------------------------------------------------------------
 
-async def init_db(filename):
-	db = await aiosqlite.connect(filename, isolation_level = None) # isolation_level: autocommit TODO: parameterize DB ID!
+async def init_db(filename, content_filename = None, migrate = True, in_memory = False):
+	'''
+	Open the (read/write) user database at `filename`.  If `content_filename` is given, the
+	(read-only) curriculum content database is ATTACHed alongside, as "content"; sqlite
+	resolves unqualified table names (event, science, resource...) to the attached content
+	tables, so sql.py and db.py queries needn't know about the split.  If `in_memory`, what's
+	attached is an in-memory snapshot of `content_filename` (see content_snapshot.py).
+	If `migrate`, pending schema migrations are applied first (see migrate.py).
+	'''
+	db = await aiosqlite.connect(filename, isolation_level = None, uri = True) # isolation_level: autocommit; uri: so that the content db can be ATTACHed with ro/immutable flags (plain filenames still work as usual)
 		# non-async equivalent would have been: db = sqlite3.connect('test1.db', isolation_level = None) # isolation_level: autocommit
 	db.row_factory = aiosqlite.Row
-	await db.execute('pragma journal_mode = wal') # see https://charlesleifer.com/blog/going-fast-with-sqlite-and-python/ - since we're using async/await from a wsgi stack, this is appropriate
+	await (await db.execute('pragma journal_mode = wal')).close() # (close: else the statement stays "in progress", and migrate's commit fails); see https://charlesleifer.com/blog/going-fast-with-sqlite-and-python/ - since we're using async/await from a wsgi stack, this is appropriate
 	#await db.execute('pragma case_sensitive_like = true')
 	#await db.set_trace_callback(l.debug) - not needed with aiosqlite, anyway
+	if migrate:
+		async with _writing:
+			await migrate_.migrate(db, ('user',) if content_filename else migrate_.k_tracks)
+	if content_filename:
+		snapshot = await content_snapshot.take(content_filename) if in_memory else None
+		async with _writing:
+			await db.executescript(_attach_content(content_filename, snapshot))
+		if snapshot:
+			_snapshots[db] = snapshot
+		if migrate:
+			await migrate_.check_content(db)
 	return db
 
+async def swap_content_db(db, content_filename):
+	'''
+	Detach the current content db and attach `content_filename` in its place.  Both happen
+	in one executescript() call, which aiosqlite runs as a single job on its own thread, so
+	no other query can slip in between and find the content tables missing.  It waits out
+	any write in progress (see db.writing), since executescript() commits an open transaction.
+	If `db` serves content from an in-memory snapshot, a fresh one is taken and swapped in.
+	'''
+	old = _snapshots.get(db)
+	snapshot = await content_snapshot.take(content_filename) if old else None
+	for attempt in range(k_swap_attempts):
+		try:
+			async with _writing:
+				await db.executescript('detach database content; ' + _attach_content(content_filename, snapshot))
+			if snapshot:
+				_snapshots[db] = snapshot
+				content_snapshot.release(old)
+			return
+		except OperationalError as e: # "database content is locked" if a cursor is still mid-statement; try again shortly
+			l.warning('content db swap attempt %d failed (%s)' % (attempt + 1, e))
+			await asyncio.sleep(0.1)
+	content_snapshot.release(snapshot)
+	raise OperationalError('unable to swap content db after %d attempts' % k_swap_attempts)
+
+async def publish_content_db(db, content_filename):
+	'''
+	If a new curriculum has been staged (`content_filename` + settings.k_content_staged_suffix),
+	atomically rename it into place, then re-attach.  The old attachment keeps reading the
+	old (unlinked) inode until the swap, so no reader ever sees a half-written file.
+	'''
+	staged = content_filename + settings.k_content_staged_suffix
+	if os.path.exists(staged):
+		os.replace(staged, content_filename)
+		l.info('published staged content db "%s"' % staged)
+	await swap_content_db(db, content_filename)
+
+k_swap_attempts = 10
+
+_snapshots = weakref.WeakKeyDictionary() # {db: content_snapshot.Snapshot} for dbs serving content from memory
+
+def _attach_content(filename, snapshot = None):
+	uri = snapshot.uri if snapshot else 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(filename))
+	return "attach database '%s' as content; pragma content.mmap_size = %d; pragma content.cache_size = %d;" % (
+		uri.replace("'", "''"), settings.k_content_mmap_size, settings.k_content_cache_size)
+
 async def _init(app):
 	l.debug('Initializing database...')
-	app['db'] = await init_db('ohs-test.db')
+	if settings.k_content_in_memory and not settings.k_content_db_filename:
+		l.warning('k_content_in_memory requires a separate content db (k_content_db_filename); serving content from disk')
+	app['db'] = await init_db(settings.k_db_filename, settings.k_content_db_filename, in_memory = settings.k_content_in_memory)
+	app['content_generation'] = 0 # bumped whenever new content is swapped in
 	l.debug('...database initialized')
+	app['ready'] = False # until _warm_up() is done; see /health
+	app['warm_up'] = asyncio.ensure_future(_warm_up(app)) # in the background, so that the server can answer /health (with 503) in the meantime
+	app['reaper'] = asyncio.ensure_future(_reap(app))
+	app['content_watcher'] = asyncio.ensure_future(_watch_content(app)) if settings.k_content_db_filename and settings.k_content_watch_interval else None
+	app['data_version_watcher'] = asyncio.ensure_future(_watch_data_version(app)) if not settings.k_content_db_filename and settings.k_resource_bundle_check_interval else None
+	db.answer_log.open(app['db'])
+	app['answer_flusher'] = asyncio.ensure_future(_flush_answers())
+	app['loop_monitor'] = loop_monitor.start() if settings.k_loop_lag_monitor else None
+	render.start()
+
+async def _warm_up(app):
+	'''
+	Pay the first-request costs (cold page cache, statement preparation, dominate imports
+	and rendering paths) before any student does, then declare this instance ready.
+	'''
+	start = time.perf_counter()
+	try:
+		await cw_index.build(app['db']) # (first, so that warm-up exercises the indexed query paths)
+		await resource_bundles.build(app['db'])
+		transactions = await db.warm_up(app['db'], dict([(db_handler, _renderer_fields(html_function)) for path, db_handler, html_function in quizzes]))
+		for path, db_handler, html_function in quizzes:
+			if db_handler in transactions:
+				transaction = transactions[db_handler]
+				html.exposed[html_function](transaction.question, transaction.options)
+				html.quiz(path, db_handler, html_function) # (path stands in for ws url, here)
+		html.home()
+		html.login(settings.k_url_prefix + '/login')
+		await render.warm_up()
+		html.resources(settings.k_url_prefix + '/resources', (('context', 'choose_context', [(context['name'], context['id']) for context in await db.get_contexts(app['db'])]),), {})
+	except Exception as e: # better to serve, cold, than not at all
+		l.error('Exception (%s: %s) during warm-up; continuing on...' % (str(e), type(e)))
+	app['ready'] = True
+	app['warm_up_seconds'] = time.perf_counter() - start
+	l.info('warm-up complete in %.3f seconds; ready for traffic' % app['warm_up_seconds'])
 	
 async def _shutdown(app):
+	'''
+	Drain: refuse new websockets, hint to every client that it should reconnect (which
+	the reverse proxy will route to another instance), close all sockets concurrently
+	within settings.k_drain_timeout, then let in-flight DB work finish.  The DB itself is
+	closed last, in _cleanup(), after aiohttp has finished with the handlers.
+	'''
 	l.debug('Shutting down...')
+	start = time.perf_counter()
+	app['draining'] = True
+	app['warm_up'].cancel() # in case we're shut down before we even got going
+	app['reaper'].cancel()
+	for task in (app['content_watcher'], app['data_version_watcher'], app['answer_flusher']):
+		if task:
+			task.cancel()
+	if app['loop_monitor']:
+		loop_monitor.stop(app['loop_monitor'])
+
+	async def close(ws):
+		try:
+			await ws.send_json({'call': 'reconnect', 'delay': settings.k_reconnect_delay_ms})
+		except Exception: # (e.g., client already gone)
+			pass
+		await ws.close(code = WSCloseCode.GOING_AWAY, message = b'Server shutdown')
+
+	closes = [asyncio.ensure_future(close(ws)) for ws in set(app['websockets'])]
+	forced = 0
+	if closes:
+		done, pending = await asyncio.wait(closes, timeout = settings.k_drain_timeout)
+		for task in pending: # clients that didn't complete the closing handshake in time; their connections are dropped with the server
+			task.cancel()
+		forced = len(pending)
+	flushed = await admission.idle(max(0, settings.k_drain_timeout - (time.perf_counter() - start)))
+	l.info('drained %d websockets in %.3f seconds (%d force-closed)%s' % (len(closes), time.perf_counter() - start, forced, '' if flushed else '; DB work still pending!'))
+
+async def _cleanup(app):
+	render.stop()
+	await db.answer_log.close() # (flushing the last answers; the websockets are all closed by now)
 	await app['db'].close()
-	for ws in set(app['websockets']):
-		await ws.close(code = WSCloseCode.GOING_AWAY, message = 'Server shutdown')
+	content_snapshot.release(_snapshots.pop(app['db'], None))
 	l.debug('...shutdown complete')
 
 
 	
+# Quizzes: (url path, db.py question-transaction class name, html.exposed function name):
+quizzes = (
+	(settings.k_history_sequence, 'History_Sequence_QT', 'multi_choice_history_sequence_question'),
+	('/quiz/history/geography', 'get_history_geography_question', 'multi_choice_question'),
+	('/quiz/history/detail', 'get_history_detail_question', 'multi_choice_question'),
+	('/quiz/history/submissions', 'get_history_submissions_question', 'multi_choice_question'),
+	('/quiz/history/random', 'get_history_random_question', 'multi_choice_question'),
+	('/quiz/geography/orientation', 'get_geography_orientation_question', 'multi_choice_question'),
+	('/quiz/geography/map', 'get_geography_map_question', 'multi_choice_question'),
+	(settings.k_science_grammar, 'Science_Grammar_QT', 'multi_choice_science_question'),
+	('/quiz/science/submissions', 'get_science_submissions_question', 'multi_choice_question'),
+	('/quiz/science/random', 'get_science_random_question', 'multi_choice_question'),
+	('/quiz/math/facts/multiplication', 'get_math_facts_question', 'multi_choice_question'),
+	('/quiz/math/grammar', 'get_math_grammar_question', 'multi_choice_question'),
+	(settings.k_english_grammar, 'English_Grammar_QT', 'multi_choice_english_grammar_question'),
+	(settings.k_english_vocabulary, 'English_Vocabulary_QT', 'multi_choice_english_vocabulary_question'),
+	('/quiz/english/random', 'get_english_random_question', 'multi_choice_question'),
+	('/quiz/latin/grammar', 'get_latin_grammar_question', 'multi_choice_question'),
+	(settings.k_latin_vocabulary, 'Latin_Vocabulary_QT', 'multi_choice_latin_vocabulary_question'),
+	('/quiz/latin/translation', 'get_latin_translation_question', 'multi_choice_question'),
+	('/quiz/latin/random', 'get_latin_random_question', 'multi_choice_question'),
+	('/quiz/music/note', 'get_music_note_question', 'multi_choice_question'),
+	('/quiz/music/key_signature', 'get_music_key_signature_question', 'multi_choice_question'),
+	('/quiz/music/submissions', 'get_music_submissions_question', 'multi_choice_question'),
+	('/quiz/music/random', 'get_music_random_question', 'multi_choice_question'),
+)
+
 # Run server like so, from cli:
 #		python -m aiohttp.web -H localhost -P 8080 main:init
 # Or, using adev (from parent directory!):
 #		adev runserver --app-factory init --livereload --debug-toolbar test1_app
 def init(argv):
-	app = web.Application()
-	app.update(websockets = weakref.WeakSet())
+	app = web.Application(middlewares = [_name_handler, _shed_load])
+	slowlog.configure()
+	app.update(websockets = weakref.WeakKeyDictionary()) # {ws: Connection}
 
 	# Set up sessions:
 	fernet_key = fernet.Fernet.generate_key()
@@ -404,38 +879,18 @@ def init(argv):
 	def q(db_handler, html_function):
 		@auth('student') # TODO: comment this back in when it's time to auth students who are looking to quiz
 		async def quiz(request):
-			return hr(html.quiz(_ws_url(request, '/ws_quiz_handler'), db_handler, html_function))
+			return await hrc(request, lambda: html.quiz(_ws_url(request, '/ws_quiz_handler'), db_handler, html_function), db_handler, html_function)
 		return quiz
-	g = web.get
-	app.add_routes([
-		g(settings.k_history_sequence, q('History_Sequence_QT', 'multi_choice_history_sequence_question')),
-		g('/quiz/history/geography', q('get_history_geography_question', 'multi_choice_question')),
-		g('/quiz/history/detail', q('get_history_detail_question', 'multi_choice_question')),
-		g('/quiz/history/submissions', q('get_history_submissions_question', 'multi_choice_question')),
-		g('/quiz/history/random', q('get_history_random_question', 'multi_choice_question')),
-		g('/quiz/geography/orientation', q('get_geography_orientation_question', 'multi_choice_question')),
-		g('/quiz/geography/map', q('get_geography_map_question', 'multi_choice_question')),
-		g(settings.k_science_grammar, q('Science_Grammar_QT', 'multi_choice_science_question')),
-		g('/quiz/science/submissions', q('get_science_submissions_question', 'multi_choice_question')),
-		g('/quiz/science/random', q('get_science_random_question', 'multi_choice_question')),
-		g('/quiz/math/facts/multiplication', q('get_math_facts_question', 'multi_choice_question')),
-		g('/quiz/math/grammar', q('get_math_grammar_question', 'multi_choice_question')),
-		g(settings.k_english_grammar, q('English_Grammar_QT', 'multi_choice_english_grammar_question')),
-		g(settings.k_english_vocabulary, q('English_Vocabulary_QT', 'multi_choice_english_vocabulary_question')),
-		g('/quiz/english/random', q('get_english_random_question', 'multi_choice_question')),
-		g('/quiz/latin/grammar', q('get_latin_grammar_question', 'multi_choice_question')),
-		g(settings.k_latin_vocabulary, q('Latin_Vocabulary_QT', 'multi_choice_latin_vocabulary_question')),
-		g('/quiz/latin/translation', q('get_latin_translation_question', 'multi_choice_question')),
-		g('/quiz/latin/random', q('get_latin_random_question', 'multi_choice_question')),
-		g('/quiz/music/note', q('get_music_note_question', 'multi_choice_question')),
-		g('/quiz/music/key_signature', q('get_music_key_signature_question', 'multi_choice_question')),
-		g('/quiz/music/submissions', q('get_music_submissions_question', 'multi_choice_question')),
-		g('/quiz/music/random', q('get_music_random_question', 'multi_choice_question')),
-	])
+	app.add_routes([web.get(path, q(db_handler, html_function)) for path, db_handler, html_function in quizzes])
+	# And, optionally, static files (else served by a separate server at settings.k_static_url):
+	if settings.k_serve_static:
+		static.scan() # must precede any html rendering, so that html.py gets fingerprinted URLs
+		app.router.add_get(settings.k_static_route + '{path:.+}', static.handler)
 	
 	# Add startup/shutdown hooks:
 	app.on_startup.append(_init)
 	app.on_shutdown.append(_shutdown)
+	app.on_cleanup.append(_cleanup)
 
 	return app
 
@@ -0,0 +1,231 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Audio / PDF serving (static/audio/<subject>/cWwN.mp3|.pdf; see html._resources()).
+
+Browsers seeking through a memory song issue many Range requests, and a whole class
+tends to hit the same week's file at once, so:
+	* open files are kept in a small LRU cache, rather than opened for every request
+	* bodies go out via loop.sendfile() (zero-copy, where the transport allows), falling
+	  back to os.pread() chunks (e.g., under TLS); both read at an explicit offset, so one
+	  cached file object may serve any number of concurrent responses
+	* Range (single range; a multi-range request is answered with the whole file, as
+	  RFC 7233 permits), If-Range, If-Match, If-None-Match and If-Modified-Since are honored,
+	  against a strong ETag built from inode, size and mtime
+'''
+
+import asyncio
+import collections
+import mimetypes
+import os
+import time
+
+from aiohttp import web
+from email.utils import formatdate, parsedate_to_datetime
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import settings
+
+# -----------------------------------------------------------------------------
+
+class Open_File:
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'rb')
+		st = os.fstat(self.file.fileno())
+		self.size = st.st_size
+		self.mtime = int(st.st_mtime)
+		self.etag = '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+		self.last_modified = formatdate(self.mtime, usegmt = True)
+		self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		self.checked = time.monotonic()
+		self.users = 0 # responses currently sending from this file
+		self.evicted = False
+
+	def stale(self):
+		# Has the file been replaced or modified since we opened it?
+		try:
+			st = os.stat(self.path)
+		except FileNotFoundError:
+			return True
+		return self.etag != '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+	def release(self):
+		self.users -= 1
+		if self.evicted and not self.users:
+			self.file.close()
+
+	def evict(self):
+		self.evicted = True
+		if not self.users:
+			self.file.close()
+
+_open_files = collections.OrderedDict() # {path: Open_File}, least-recently-used first
+
+def acquire(path):
+	'''
+	Return an Open_File for `path`, from cache if possible; caller must release() it when done.
+	'''
+	entry = _open_files.get(path)
+	if entry:
+		now = time.monotonic()
+		if now - entry.checked > settings.k_media_revalidate_interval:
+			entry.checked = now
+			if entry.stale():
+				del _open_files[path]
+				entry.evict()
+				entry = None
+	if entry:
+		_open_files.move_to_end(path)
+	else:
+		entry = _open_files[path] = Open_File(path) # raises FileNotFoundError, as it should
+		while len(_open_files) > settings.k_media_fd_cache_size:
+			path_, evictee = _open_files.popitem(last = False)
+			evictee.evict()
+	entry.users += 1
+	return entry
+
+def clear():
+	while _open_files:
+		path, entry = _open_files.popitem()
+		entry.evict()
+
+
+async def serve(request, path, cache_control = 'no-cache'):
+	try:
+		entry = acquire(path)
+	except FileNotFoundError:
+		raise web.HTTPNotFound()
+	try:
+		headers = {
+			'Accept-Ranges': 'bytes',
+			'ETag': entry.etag,
+			'Last-Modified': entry.last_modified,
+			'Cache-Control': cache_control,
+		}
+
+		# Preconditions (RFC 7232, section 6 order):
+		if_match = request.headers.get('If-Match')
+		if if_match and not _etag_matches(if_match, entry.etag):
+			raise web.HTTPPreconditionFailed(headers = headers)
+		if_none_match = request.headers.get('If-None-Match')
+		if if_none_match:
+			if _etag_matches(if_none_match, entry.etag):
+				raise web.HTTPNotModified(headers = headers)
+		elif _not_modified_since(request.headers.get('If-Modified-Since'), entry.mtime):
+			raise web.HTTPNotModified(headers = headers)
+
+		offset, count, status = 0, entry.size, 200
+		range_header = request.headers.get('Range')
+		if range_header and _if_range_holds(request.headers.get('If-Range'), entry):
+			byte_range = _parse_range(range_header, entry.size)
+			if byte_range == k_unsatisfiable:
+				headers['Content-Range'] = 'bytes */%d' % entry.size
+				raise web.HTTPRequestRangeNotSatisfiable(headers = headers)
+			if byte_range:
+				offset, count, status = byte_range[0], byte_range[1] - byte_range[0] + 1, 206
+				headers['Content-Range'] = 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], entry.size)
+
+		response = File_Response(entry, offset, count, status, headers)
+		await response.prepare(request)
+		return response
+	finally:
+		entry.release()
+
+
+class File_Response(web.StreamResponse):
+	def __init__(self, entry, offset, count, status, headers):
+		super().__init__(status = status, headers = headers)
+		self.content_type = entry.content_type
+		self.content_length = count
+		self._entry = entry
+		self._offset = offset
+		self._count = count
+
+	async def prepare(self, request):
+		if self.prepared:
+			return await super().prepare(request)
+		writer = await super().prepare(request)
+		if request.method == 'HEAD' or not self._count:
+			await super().write_eof()
+			return writer
+
+		loop = asyncio.get_event_loop()
+		try:
+			# fallback = False: asyncio's own fallback would seek() and read() our shared file object, which concurrent responses would trample:
+			await loop.sendfile(request.transport, self._entry.file, self._offset, self._count, fallback = False)
+		except (NotImplementedError, RuntimeError): # e.g., TLS transport, or a loop (uvloop) without sendfile; raised before anything is sent
+			await self._send_chunks(writer, loop)
+		await super().write_eof()
+		return writer
+
+	async def _send_chunks(self, writer, loop):
+		fd, offset, remaining = self._entry.file.fileno(), self._offset, self._count
+		while remaining > 0:
+			chunk = await loop.run_in_executor(None, os.pread, fd, min(settings.k_media_chunk_size, remaining), offset)
+			if not chunk:
+				break # file shrank underneath us; nothing sensible to do but stop
+			await writer.write(chunk)
+			offset += len(chunk)
+			remaining -= len(chunk)
+		await writer.drain()
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+k_unsatisfiable = 'unsatisfiable'
+
+def _parse_range(header, size):
+	'''
+	Returns an inclusive (first, last) byte pair, None to ignore the header (malformed or
+	multi-range: serve the whole thing), or k_unsatisfiable.
+	'''
+	unit, _, spec = header.partition('=')
+	if unit.strip().lower() != 'bytes' or ',' in spec:
+		return None
+	first, dash, last = spec.strip().partition('-')
+	if not dash:
+		return None
+	try:
+		if not first: # suffix range: "-500" means the last 500 bytes
+			length = int(last)
+			if length <= 0:
+				return k_unsatisfiable
+			return max(0, size - length), size - 1
+		first = int(first)
+		last = int(last) if last else size - 1
+	except ValueError:
+		return None
+	if first >= size:
+		return k_unsatisfiable
+	if last < first:
+		return None
+	return first, min(last, size - 1)
+
+def _etag_matches(header, etag):
+	if header.strip() == '*':
+		return True
+	return etag in [tag.strip() for tag in header.split(',')]
+
+def _not_modified_since(header, mtime):
+	if not header:
+		return False
+	try:
+		return mtime <= parsedate_to_datetime(header).timestamp()
+	except (TypeError, ValueError):
+		return False
+
+def _if_range_holds(header, entry):
+	# Honor Range only if If-Range is absent or still matches the current representation (else send the whole, new, file)
+	if not header:
+		return True
+	header = header.strip()
+	if header.startswith('"'):
+		return header == entry.etag # strong comparison
+	return header == entry.last_modified
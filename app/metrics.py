@@ -0,0 +1,45 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Process-wide counters, gauges and histograms, served (as JSON), to admins, at /metrics; e.g.,
+	metrics.inc('conditional.not_modified')
+	metrics.inc('conditional.bytes_saved', len(body))
+	metrics.gauge('ws.live', len(app['websockets']))
+	metrics.observe('admission.wait.quiz', seconds) # reported as percentiles
+'''
+
+import collections
+
+counters = collections.Counter()
+gauges = dict()
+histograms = collections.defaultdict(lambda: collections.deque(maxlen = k_reservoir_size)) # most recent observations only
+
+k_reservoir_size = 2048
+k_percentiles = (50, 95, 99)
+
+def inc(name, amount = 1):
+	counters[name] += amount
+
+def gauge(name, value):
+	gauges[name] = value
+
+def observe(name, value):
+	histograms[name].append(value)
+
+def percentiles(values):
+	values = sorted(values)
+	if not values:
+		return {}
+	result = dict([('p%d' % p, values[min(len(values) - 1, len(values) * p // 100)]) for p in k_percentiles])
+	result.update(count = len(values), max = values[-1])
+	return result
+
+def snapshot():
+	return {
+		'counters': dict(counters),
+		'gauges': dict(gauges),
+		'histograms': dict([(name, percentiles(values)) for name, values in histograms.items()]),
+	}
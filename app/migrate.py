@@ -0,0 +1,132 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Versioned schema migrations.
+
+Migrations live in settings.k_schema_dir, one directory per "track":
+	schema/user/0001_tables.sql, 0002_indexes.sql, ... - the (read/write) user db
+	schema/content/0001_tables.sql, ... - curriculum content
+In the usual, single-db layout, both tracks apply to the one db; with a separate content
+db (settings.k_content_db_filename), that db is opened read-only, so its migrations are
+applied offline, before publishing (see README).
+
+Each db records its version per track in a `schema_version` table.  Each pending migration
+runs, with its version bump, in one transaction, so a failure leaves the db at the last
+good version.  Migrations must be idempotent (`create ... if not exists`, `insert or
+ignore`...), since two processes starting at once might both apply the same one, and so that
+a db which predates versioning simply "migrates" to its existing shape.
+
+main.init_db() migrates at startup; or:
+
+	$ python -m app.migrate ohs-test.db
+	$ python -m app.migrate --track content ohs-content.db.new
+	$ python -m app.migrate --status ohs-test.db
+'''
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+
+from sqlite3 import OperationalError
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import settings
+
+k_tracks = ('user', 'content')
+k_version_table = 'create table if not exists schema_version (track text primary key, version integer not null);'
+
+_rec_migration = re.compile(r'^(\d+)_\w+\.sql$')
+
+# -----------------------------------------------------------------------------
+
+def migrations(track, directory = settings.k_schema_dir):
+	'''
+	Return a sorted list of (version, path) for `track`.
+	'''
+	result = []
+	for filename in os.listdir(os.path.join(directory, track)):
+		match = _rec_migration.match(filename)
+		if match:
+			result.append((int(match.group(1)), os.path.join(directory, track, filename)))
+	return sorted(result)
+
+def latest(track):
+	m = migrations(track)
+	return m[-1][0] if m else 0
+
+async def version(db, track, schema = 'main'):
+	try:
+		c = await db.execute(f'select version from "{schema}".schema_version where track = ?', (track,))
+		rows = await c.fetchall() # (all, so that the statement is finished before any commit)
+	except OperationalError: # no schema_version table yet: unversioned
+		return 0
+	return rows[0][0] if rows else 0
+
+async def migrate(db, tracks = k_tracks):
+	'''
+	Apply all pending migrations, for `tracks`, to the main db of `db` (an aiosqlite
+	connection in autocommit mode; see main.init_db()).  Returns the number applied.
+	'''
+	applied = 0
+	for track in tracks:
+		current = await version(db, track)
+		for number, path in migrations(track):
+			if number <= current:
+				continue
+			with open(path) as f:
+				script = f.read()
+			try:
+				await db.executescript('\n'.join((
+					'begin immediate;',
+					k_version_table,
+					script,
+					f"insert or replace into schema_version (track, version) values ('{track}', {number});",
+					'commit;')))
+			except Exception as e:
+				try:
+					await db.execute('rollback')
+				except OperationalError:
+					pass # (sqlite had already rolled back)
+				l.error('schema: migration %s failed (%s); "%s" remains at version %d' % (path, e, track, current))
+				raise
+			l.info('schema: "%s" migrated to version %d (%s)' % (track, number, os.path.basename(path)))
+			current = number
+			applied += 1
+	return applied
+
+async def check_content(db):
+	'''
+	The (immutable, ATTACHed) content db can't be migrated in place; just warn if it's behind.
+	'''
+	current, wanted = await version(db, 'content', 'content'), latest('content')
+	if current < wanted:
+		l.warning('schema: content db is at version %d, but %d is current; migrate it (python -m app.migrate --track content ...) and republish' % (current, wanted))
+
+
+async def run(args):
+	from . import main # (here, not at top; main imports us)
+	logging.getLogger().setLevel(logging.INFO) # (main sets DEBUG)
+	db = await main.init_db(args.filename, migrate = False)
+	try:
+		tracks = (args.track,) if args.track else k_tracks
+		if not args.status:
+			print('%d migrations applied' % await migrate(db, tracks))
+		for track in tracks:
+			print('%s: version %d (latest %d)' % (track, await version(db, track), latest(track)))
+	finally:
+		await db.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Apply pending schema migrations (see %s/)' % settings.k_schema_dir)
+	parser.add_argument('filename', nargs = '?', default = settings.k_db_filename)
+	parser.add_argument('--track', choices = k_tracks, help = 'just this track (default: all; i.e., a single-db layout)')
+	parser.add_argument('--status', action = 'store_true', help = 'report versions; change nothing')
+	sys.exit(asyncio.run(run(parser.parse_args())))
@@ -0,0 +1,263 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Query-plan auditor: generates every statement shape that sql.py and db.py produce (using
+representative specs), runs EXPLAIN QUERY PLAN on each, and flags full scans ("SCAN ...")
+and temporary sorts ("USE TEMP B-TREE ..."), suggesting an index where one would help.
+
+The quiz/resource shapes are generated twice: "sql:" with the cycle/week filter done in
+SQL (cw_index not built), and "indexed:" as the server normally runs them (see cw_index.py).
+
+Flags are compared against a checked-in baseline (plan_baseline.json); any flag not in the
+baseline is a regression, and the exit status is 1.  After an intended change (e.g., a new
+index, or a new, accepted, `order by random()`, or new or changed statement shapes),
+regenerate the baseline, in the same commit:
+
+	$ python -m app.plan_audit [--db ohs-test.db] [--content-db ohs-content.db] [--update] [-v]
+
+Plans depend on the planner's statistics (sqlite_stat1), which the server refreshes at
+warm-up (db.warm_up()).  A db that has never been analyzed (e.g., freshly migrated, and loaded
+with app.ingest) plans differently - more scans and temp sorts - than the server will; audit
+it with --analyze, which first analyzes it as warm-up would.  The baseline is of an analyzed
+db, with the curriculum loaded.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sys
+
+from sqlite3 import OperationalError
+
+from . import main
+from . import db
+from . import sql
+from . import cw_index
+from . import settings
+
+k_baseline = 'plan_baseline.json'
+k_flags = ('SCAN ', 'USE TEMP B-TREE')
+
+# -----------------------------------------------------------------------------
+
+class Recorder:
+	'''
+	Stands in for the db connection, recording each statement on its way through.
+	'''
+	def __init__(self, db):
+		self.db = db
+		self.statements = []
+
+	async def execute(self, statement, args = ()):
+		if not statement.startswith('pragma '): # (e.g., result_cache.py's data_version checks; not query shapes)
+			self.statements.append((statement, args))
+		return await self.db.execute(statement, args)
+
+
+class Spec: # a stand-in for the Question_Transaction / main.Resource_Spec attributes that sql.py uses
+	def __init__(self, db, table, cycles = None, week_range = None, date_range = None, search_string = None, context = 0):
+		self.db = db
+		self.table = table
+		self.cycles = cycles
+		self.week_range = week_range
+		self.date_range = date_range
+		self.exclude_people_groups = True
+		self.search_string = search_string
+		self.context = context
+
+
+k_filters = ( # (label, cycles, week_range)
+	('all', None, None),
+	('weeks', None, (3, 9)),
+	('cycles+weeks', (0, 2), (3, 9)),
+)
+
+async def shapes(dbc):
+	'''
+	Returns a list of (shape name, [(statement, args), ...]) pairs.
+	'''
+	result = []
+	async def record(name, call):
+		recorder = Recorder(dbc)
+		await call(recorder)
+		result.append((name, recorder.statements))
+
+	for mode in ('sql', 'indexed'):
+		if mode == 'indexed':
+			await cw_index.build(dbc)
+		else:
+			cw_index.clear()
+		for label, cycles, week_range in k_filters:
+			for table in ('science', 'vocabulary', 'english', 'latin_vocabulary'):
+				spec = Spec(dbc, table, cycles, week_range)
+				result.append((f'{mode}:get_random_records[{table}, {label}]', [sql.get_random_records(spec, 1)]))
+				result.append((f'{mode}:get_random_records[{table}, {label}, excluding]', [sql.get_random_records(spec, 4, [1, 2])]))
+
+			spec = Spec(dbc, 'event', cycles, week_range, (1500, 1750))
+			result.append((f'{mode}:get_random_event_records[{label}]', [sql.get_random_event_records(spec, 1)]))
+			event = await sql.fetchone(dbc, ("select * from event where keywords is not null and keywords != '' limit 1", []))
+			if event:
+				spec = Spec(None, 'event', cycles, week_range, None)
+				async def surrounding(recorder):
+					spec.db = recorder
+					await sql.get_surrounding_event_records(spec, 5, event)
+				await record(f'{mode}:get_surrounding_event_records[{label}]', surrounding)
+
+			for subject_spec in sql.subject_specs:
+				for search_string in (None, 'a'):
+					spec = Spec(None, subject_spec.table, cycles, week_range, search_string = search_string)
+					async def grammar(recorder):
+						spec.db = recorder
+						await sql._get_grammar_resources(spec, subject_spec)
+					await record(f'{mode}:_get_grammar_resources[{subject_spec.subject}, {label}%s]' % (', search' if search_string else ''), grammar)
+
+	async def external(recorder):
+		await sql._get_external_resources(Spec(recorder, None, context = 2))
+	await record('_get_external_resources', external)
+	await record('get_contexts', lambda recorder: sql.get_contexts(recorder))
+	await record('get_users_limited', lambda recorder: db.get_users_limited(recorder, 10))
+	await record('find_users', lambda recorder: db.find_users(recorder, 'a'))
+	await record('get_user[username]', lambda recorder: db.get_user(recorder, (('username', 'nobody'),)))
+	await record('get_user[id]', lambda recorder: db.get_user(recorder, (('id', 1),)))
+	await record('get_progress', lambda recorder: db.get_progress(recorder, 1))
+	await record('get_progress[subject]', lambda recorder: db.get_progress(recorder, 1, 'science'))
+	await record('authenticate', lambda recorder: db.authenticate(recorder, 'nobody', 'x')) # (an unknown user, so only the first statement; roles are audited directly, below)
+	result.append(('authenticate[roles]', [('select role.name as role_name from role join user_role on role.id = user_role.role join user on user.id = user_role.user where user.username = ?', ('nobody',))]))
+	return result
+
+
+async def audit(dbc, verbose = False):
+	'''
+	Returns ({shape name: [flagged plan steps]}, {suggestion: [shape names]}), printing each
+	shape's plan if `verbose`.
+	'''
+	report, suggestions = dict(), dict()
+	for name, statements in await shapes(dbc):
+		flagged = []
+		for i, (statement, args) in enumerate(statements):
+			c = await dbc.execute('explain query plan ' + statement, args)
+			steps = [_normalized(row[3]) for row in await c.fetchall()]
+			flags = [step for step in steps if step.startswith(k_flags)]
+			flagged.extend(['#%d %s' % (i + 1, step) if len(statements) > 1 else step for step in flags])
+			if verbose:
+				print('%s%s:\n\t%s\n\t\t%s' % (name, ' #%d' % (i + 1) if len(statements) > 1 else '', _abbreviated(statement), '\n\t\t'.join(steps)))
+			for suggestion in _suggestions(statement, flags):
+				suggestions.setdefault(suggestion, []).append(name)
+		report[name] = sorted(set(flagged))
+	return report, suggestions
+
+
+def compare(report, baseline):
+	'''
+	Returns (regressions, improvements), each a list of (shape name, flag) pairs.
+	'''
+	regressions, improvements = [], []
+	for name, flags in report.items():
+		known = baseline.get(name)
+		if known is None:
+			regressions.extend([(name, flag) for flag in flags]) # a new shape; anything flagged must be reviewed (and accepted with --update)
+			continue
+		regressions.extend([(name, flag) for flag in flags if flag not in known])
+		improvements.extend([(name, flag) for flag in known if flag not in flags])
+	return regressions, improvements
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _normalized(step):
+	# Older SQLite versions say "SCAN TABLE x" and "SEARCH TABLE x"; newer just "SCAN x"
+	return re.sub(r'^(SCAN|SEARCH) TABLE ', r'\1 ', step)
+
+def _abbreviated(statement):
+	return re.sub(r' in \((\d+, ){8,}\d+\)', ' in (...)', statement) # id lists (see cw_index.py) can be long
+
+_rec_alias = re.compile(r'(\w+) as (\w+)', re.IGNORECASE)
+_rec_predicate = re.compile(r'(\w+)\.(\w+)\s*(?:=|<=|>=|<|>|\bin\b)|(?:=|<=|>=|<|>)\s*(\w+)\.(\w+)', re.IGNORECASE)
+
+def _suggestions(statement, flags):
+	'''
+	For each scanned table, suggest an index on the columns the statement compares (by
+	equality, range or join) - a heuristic; leading-wildcard LIKEs, for example, can't be helped.
+	'''
+	aliases = dict([(alias, table) for table, alias in _rec_alias.findall(statement)])
+	columns = dict()
+	for table, column, table_, column_ in _rec_predicate.findall(statement):
+		table, column = (table, column) if table else (table_, column_)
+		table = aliases.get(table, table)
+		if column != 'id': # already the (integer) primary key
+			columns.setdefault(table, []).append(column)
+	result = []
+	for flag in flags:
+		if flag.startswith('SCAN '):
+			table = aliases.get(flag.split()[1], flag.split()[1])
+			cols = list(dict.fromkeys(columns.get(table, []))) # (unique, in order)
+			if cols:
+				result.append('consider: create index if not exists %s_%s on %s(%s);' % (table, '_'.join(cols), table, ', '.join(cols)))
+		elif 'ORDER BY' in flag and 'random()' not in statement:
+			result.append('consider: an index matching the ORDER BY (%s)' % _abbreviated(statement.rsplit(' order by ', 1)[-1]))
+	return result
+
+
+async def analyze(dbc):
+	# As db.warm_up() does; the (immutable) content db, if separate, must have been analyzed before publishing
+	for schema in await sql.fetchall(dbc, ('pragma database_list', [])):
+		try:
+			await sql.fetchall(dbc, ('analyze "%s"' % schema['name'], []))
+		except OperationalError as e:
+			print('warning: could not analyze "%s" (%s)' % (schema['name'], e))
+
+async def _analyzed(dbc):
+	return bool(await sql.fetchall(dbc, ("select name from sqlite_master where name = 'sqlite_stat1'", [])))
+
+
+async def run(args):
+	dbc = await main.init_db(args.db, args.content_db, migrate = False) # (audit the db as it is)
+	try:
+		if args.analyze:
+			await analyze(dbc)
+		elif not await _analyzed(dbc):
+			print('warning: no planner statistics (sqlite_stat1) in %s; the server analyzes at warm-up, so its plans (and the baseline\'s) may differ from these - run with --analyze' % args.db)
+		report, suggestions = await audit(dbc, args.verbose)
+	finally:
+		await dbc.close()
+	for suggestion, names in sorted(suggestions.items()):
+		print('%s\n\t(for %s%s)' % (suggestion, ', '.join(sorted(set(names))[:3]), ', ...' if len(set(names)) > 3 else ''))
+
+	if args.update:
+		with open(args.baseline, 'w') as f:
+			json.dump(report, f, indent = '\t', sort_keys = True)
+			f.write('\n')
+		print('baseline (%d shapes) written to %s' % (len(report), args.baseline))
+		return 0
+
+	try:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	except FileNotFoundError:
+		print('no baseline (%s); run with --update to create one' % args.baseline)
+		return 1
+	regressions, improvements = compare(report, baseline)
+	for name, flag in improvements:
+		print('improved: %s: no longer %s (run with --update to accept)' % (name, flag))
+	for name, flag in regressions:
+		print('REGRESSION: %s: %s' % (name, flag))
+	print('%d shapes audited; %d flagged steps; %d regressions' % (len(report), sum([len(flags) for flags in report.values()]), len(regressions)))
+	return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'EXPLAIN QUERY PLAN every statement shape that sql.py and db.py generate')
+	parser.add_argument('--db', default = settings.k_db_filename)
+	parser.add_argument('--content-db', default = settings.k_content_db_filename)
+	parser.add_argument('--baseline', default = k_baseline)
+	parser.add_argument('--update', action = 'store_true', help = 'write the current flags as the new baseline')
+	parser.add_argument('-v', '--verbose', action = 'store_true', help = 'print every plan')
+	parser.add_argument('--analyze', action = 'store_true', help = 'first refresh the planner statistics, as the server\'s warm-up does (writes them to the db)')
+	logging.getLogger().setLevel(logging.WARNING) # (main sets DEBUG; this is a report)
+	sys.exit(asyncio.run(run(parser.parse_args())))
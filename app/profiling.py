@@ -0,0 +1,167 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+On-demand profiling of the live process (see main.profile_ and the /admin/profile routes).
+
+A Session profiles either for a number of seconds, or for the next N websocket messages
+of one handler (e.g., 'ws_quiz_handler'; main._ws_handler() wraps each message in
+message()).  Either or both of:
+	* cProfile - exact call counts and times; written as <name>.pstats (load with pstats,
+	  snakeviz, etc.)
+	* sampling - a thread snapshots the loop thread's stack every settings.k_profile_sample_interval
+	  seconds; written as <name>.collapsed ("outer;...;inner count" lines, for flamegraph.pl
+	  or speedscope); much cheaper, so it's kinder to production traffic
+Note that the loop is one thread, so while a message is being profiled, any other work the
+loop interleaves with it (during its awaits) is profiled, too.
+Files go to settings.k_profile_dir.  One session at a time.
+'''
+
+import asyncio
+import collections
+import contextlib
+import cProfile
+import os
+import sys
+import threading
+import time
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import settings
+
+# -----------------------------------------------------------------------------
+
+class Session:
+	def __init__(self, name, use_cprofile = True, sample = True, handler = None, messages = None):
+		self.name = name
+		self.handler = handler # None: profile everything, for a number of seconds (see start())
+		self.remaining = messages # messages of `handler` yet to be profiled
+		self.profile = cProfile.Profile() if use_cprofile else None
+		self.samples = collections.Counter() if sample else None
+		self.started = time.time()
+		self.files = []
+		self.done = False
+		self._active = 0 # messages in progress (handler mode), or 1 (seconds mode)
+		self._sampling = threading.Event()
+		self._thread = None
+		self._loop_thread = threading.get_ident()
+		self._timeout = None
+		if sample:
+			self._thread = threading.Thread(target = self._sample, name = 'profile_sampler', daemon = True)
+			self._thread.start()
+
+	def resume(self):
+		self._active += 1
+		if self._active == 1:
+			if self.profile:
+				self.profile.enable()
+			self._sampling.set()
+
+	def pause(self):
+		self._active -= 1
+		if self._active == 0:
+			if self.profile:
+				self.profile.disable()
+			self._sampling.clear()
+
+	def finish(self):
+		if self.done:
+			return
+		self.done = True
+		while self._active:
+			self.pause()
+		if self._timeout:
+			self._timeout.cancel()
+		os.makedirs(settings.k_profile_dir, exist_ok = True)
+		if self.profile:
+			self.files.append(self.name + '.pstats')
+			self.profile.dump_stats(os.path.join(settings.k_profile_dir, self.files[-1]))
+		if self.samples is not None:
+			self._sampling.set() # (release the sampler, so that it sees `done` and exits)
+			self._thread.join()
+			self.files.append(self.name + '.collapsed')
+			with open(os.path.join(settings.k_profile_dir, self.files[-1]), 'w') as f:
+				for stack, count in self.samples.most_common():
+					f.write('%s %d\n' % (stack, count))
+		l.info('profile "%s" written: %s' % (self.name, ', '.join(self.files)))
+
+	def status(self):
+		return {'name': self.name, 'handler': self.handler, 'remaining': self.remaining, 'started': self.started, 'done': self.done, 'files': self.files}
+
+	def _sample(self):
+		interval = settings.k_profile_sample_interval
+		while True:
+			self._sampling.wait()
+			if self.done:
+				return
+			frame = sys._current_frames().get(self._loop_thread)
+			if frame:
+				self.samples[_collapsed(frame)] += 1
+			time.sleep(interval)
+
+
+_session = None # the current (or latest) Session
+
+def current():
+	return _session
+
+def start(name, seconds = None, handler = None, messages = None, use_cprofile = True, sample = True):
+	'''
+	Profile for `seconds`, or for the next `messages` messages of websocket `handler` (giving
+	up after settings.k_profile_max_seconds if they don't come).  Returns the Session.
+	'''
+	global _session
+	assert bool(seconds) != bool(handler and messages)
+	if _session and not _session.done:
+		raise RuntimeError('profile "%s" is still running' % _session.name)
+	_session = session = Session(name, use_cprofile, sample, handler, messages)
+	loop = asyncio.get_event_loop()
+	if seconds:
+		session.resume()
+		session._timeout = loop.call_later(min(seconds, settings.k_profile_max_seconds), session.finish)
+	else:
+		session._timeout = loop.call_later(settings.k_profile_max_seconds, session.finish)
+	return session
+
+@contextlib.contextmanager
+def message(handler):
+	'''
+	Wrap the handling of one websocket message; profiled if the current session wants it.
+	'''
+	session = _session
+	if not session or session.done or session.handler != handler or not session.remaining:
+		yield
+		return
+	session.remaining -= 1
+	session.resume()
+	try:
+		yield
+	finally:
+		session.pause()
+		if not session.remaining and not session._active:
+			session.finish()
+
+def path(filename):
+	'''
+	The full path of profile output `filename`, or None if there's no such (safely-named) file.
+	'''
+	if os.path.basename(filename) != filename or not filename.endswith(('.pstats', '.collapsed')):
+		return None
+	result = os.path.join(settings.k_profile_dir, filename)
+	return result if os.path.isfile(result) else None
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _collapsed(frame):
+	stack = []
+	while frame:
+		code = frame.f_code
+		stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+		frame = frame.f_back
+	return ';'.join(reversed(stack))
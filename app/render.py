@@ -0,0 +1,80 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Off-loop rendering.  html.resource_list() builds a dominate node per field of every record,
+synchronously; for "all weeks" of every subject, or a big external-resources context, that's
+thousands of nodes, and the whole loop (every other socket) waits.  So renders of more than
+settings.k_render_offload_records records go to a small process pool instead:
+
+	content = await render.resource_list(records, url)
+
+The records are copied into plain dicts first (an aiosqlite.Row can't be pickled, and
+belongs to its connection, anyway).  Small renders stay inline, where they're cheaper than
+the round trip.  Workers are spawned, not forked (the parent has threads: aiosqlite's, the
+loop watchdog's...), and get static.py's manifest, so that their URLs are fingerprinted, too.
+'''
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import time
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import html
+from . import metrics
+from . import settings
+from . import static
+
+_pool = None # the worker pool, once start()ed
+
+def start(workers = settings.k_render_workers):
+	global _pool
+	if workers:
+		_pool = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'), _init_worker, (dict(static.manifest),))
+		l.info('render: %d worker processes for renders over %d records' % (workers, settings.k_render_offload_records))
+
+async def warm_up():
+	'''
+	Start the workers, and have them import html.py &c., before the first big render needs them.
+	'''
+	if _pool:
+		loop = asyncio.get_event_loop()
+		await asyncio.gather(*[loop.run_in_executor(_pool, html.resource_list, [], '') for i in range(settings.k_render_workers)])
+
+def stop():
+	global _pool
+	if _pool:
+		_pool.shutdown(wait = False)
+		_pool = None
+
+async def resource_list(results, url, show_cw = True):
+	'''
+	As html.resource_list(), but off the loop if `results` are big (see above).
+	'''
+	count = sum([len(records) for subject, records in results])
+	if not _pool or count <= settings.k_render_offload_records:
+		return html.resource_list(results, url, show_cw)
+	#else:
+	start = time.perf_counter()
+	rows = [(subject, [dict(record) for record in records]) for subject, records in results]
+	try:
+		result = await asyncio.get_event_loop().run_in_executor(_pool, html.resource_list, rows, url, show_cw)
+	except concurrent.futures.process.BrokenProcessPool: # (e.g., a worker was killed); render here, rather than fail the user
+		l.error('render: worker pool broken; rendering %d records inline' % count)
+		stop()
+		return html.resource_list(rows, url, show_cw)
+	metrics.inc('render.offloaded')
+	metrics.observe('render.offload', time.perf_counter() - start)
+	return result
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _init_worker(manifest):
+	static.manifest.update(manifest)
@@ -0,0 +1,54 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Materialized external-resource bundles, per context.
+
+Choosing a context on /resources lists its external resources: a seven-table join
+(resource_use, resource, subject, resource_instance, resource_type, resource_source,
+context), sorted five ways.  The data changes a few times a year, so build() runs that join
+once, for every context together, and keeps each context's rows, in order, along with the
+context list itself; sql._get_external_resources() and sql.get_contexts() are then lookups:
+	rows = resource_bundles.external(2) # or None, if not built
+Rebuilt whenever content is reloaded (main._reload_content()), and, with content in the
+main db (where an admin might edit it directly), when its data_version changes (see
+main._watch_data_version()).
+'''
+
+import collections
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import sql
+
+# -----------------------------------------------------------------------------
+
+_contexts = None # [context rows], once built
+_bundles = None # {context id: [external resource rows]}; replaced wholesale by build()
+
+async def build(db):
+	global _contexts, _bundles
+	contexts = await sql.fetchall(db, ('select * from context', []))
+	bundles = collections.defaultdict(list)
+	for row in await sql.fetchall(db, (sql.external_resources_select('', 'context.id as context_id, '), [])):
+		bundles[row['context_id']].append(row) # (rows arrive in each context's order; the extra column is harmless to renderers)
+	_contexts, _bundles = contexts, dict(bundles)
+	l.info('resource bundles built for %d contexts (%d rows)' % (len(contexts), sum([len(rows) for rows in _bundles.values()])))
+
+def clear():
+	global _contexts, _bundles
+	_contexts = _bundles = None
+
+def contexts():
+	return _contexts
+
+def external(context):
+	'''
+	Return the external-resource rows for `context` (an id), or None if not built.
+	'''
+	if _bundles is None:
+		return None
+	return _bundles.get(int(context), [])
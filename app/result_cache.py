@@ -0,0 +1,126 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Result cache for read statements that are pure functions of their SQL and args, as long as
+the tables beneath haven't changed (contexts, external resources, a week's grammar...).
+Opt-in, per call site:
+
+	return await fetchall(spec.db, (statement, args), cache = True)
+
+Entries are kept per connection, least-recently-used first out, within
+settings.k_result_cache_bytes (estimated).  Cached results are shared by every caller;
+treat them as read-only.
+
+Invalidation:
+	* `pragma data_version` changes whenever another connection (e.g., an admin at the
+	  sqlite3 prompt) commits to the db; it's checked at most every
+	  settings.k_result_cache_check_interval seconds, so an outside edit shows within that
+	  long.  This connection's own commits don't change it, which is why all of the app's
+	  writes (user registration, db.Answer_Log's answers) go through it: they're only to
+	  user tables, which no cached statement reads.  (Another process's commits - a second
+	  app process on the same db, ingest --in-place - do clear the cache.)
+	* a content swap (main._reload_content()) clears everything; the attached content db is
+	  immutable, so its data_version never changes.
+'''
+
+import collections
+import sys
+import time
+import weakref
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import admission
+from . import metrics
+from . import settings
+
+class _Cache:
+	__slots__ = ('entries', 'bytes', 'data_version', 'checked')
+	def __init__(self):
+		self.entries = collections.OrderedDict() # {(statement, args): (rows, bytes)}, least recently used first
+		self.bytes = 0
+		self.data_version = None
+		self.checked = 0
+
+	def clear(self):
+		self.entries.clear()
+		self.bytes = 0
+
+_caches = weakref.WeakKeyDictionary() # {db connection: _Cache}
+
+async def get(db, sql_and_args):
+	'''
+	Return the cached rows for `sql_and_args`, or None.  (Call before running the statement,
+	even on a miss, so that put() stores under a data_version read beforehand.)
+	'''
+	if not settings.k_result_cache_bytes:
+		return None
+	cache = _caches.get(db)
+	if cache is None:
+		cache = _caches[db] = _Cache()
+	await _validate(db, cache)
+	entry = cache.entries.get(_key(sql_and_args))
+	if entry is None:
+		metrics.inc('result_cache.miss')
+		return None
+	cache.entries.move_to_end(_key(sql_and_args))
+	metrics.inc('result_cache.hit')
+	return entry[0]
+
+def put(db, sql_and_args, rows):
+	cache = _caches.get(db)
+	if cache is None or cache.data_version is None:
+		return # (get() wasn't called first)
+	key = _key(sql_and_args)
+	size = _size(key, rows)
+	if size > settings.k_result_cache_bytes // 4:
+		return # not worth evicting so much else for
+	old = cache.entries.pop(key, None)
+	if old:
+		cache.bytes -= old[1]
+	cache.entries[key] = (rows, size)
+	cache.bytes += size
+	while cache.bytes > settings.k_result_cache_bytes:
+		key, (rows, size) = cache.entries.popitem(last = False)
+		cache.bytes -= size
+		metrics.inc('result_cache.evicted')
+	metrics.gauge('result_cache.bytes', sum([cache.bytes for cache in _caches.values()]))
+
+def clear():
+	for cache in _caches.values():
+		cache.clear()
+	metrics.gauge('result_cache.bytes', 0)
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+async def _validate(db, cache):
+	now = time.monotonic()
+	if cache.data_version is not None and now - cache.checked < settings.k_result_cache_check_interval:
+		return
+	async with admission.slot():
+		c = await db.execute('pragma data_version')
+		data_version = (await c.fetchone())[0]
+		await c.close()
+	cache.checked = now
+	if data_version != cache.data_version:
+		if cache.entries:
+			l.info('result cache: db changed (data_version %s -> %s); %d entries dropped' % (cache.data_version, data_version, len(cache.entries)))
+			metrics.inc('result_cache.invalidated')
+		cache.clear()
+		cache.data_version = data_version
+
+def _key(sql_and_args):
+	return (sql_and_args[0], tuple(sql_and_args[1]) if len(sql_and_args) > 1 else ())
+
+def _size(key, rows):
+	# An estimate; values dominate (rows are sqlite3.Row, a tuple of values plus a shared description)
+	size = sys.getsizeof(key[0]) + sys.getsizeof(rows)
+	for row in rows:
+		size += 64 + sum([sys.getsizeof(value) for value in row])
+	return size
@@ -14,6 +14,77 @@ k_static_url = 'http://localhost:8001/static/'
 #k_ws_url_prefix = '/practice_ws'
 #k_static_url = 'https://openhome.school/practice/static/'
 
+# Static files (in-app serving; an alternative to the separate static server at k_static_url):
+k_serve_static = False # True: serve k_static_dir at k_static_route, with fingerprinted URLs and immutable caching (see static.py)
+k_static_dir = 'static'
+k_static_route = '/static/'
+k_static_cache_dir = '.static_cache' # precompressed (gzip/brotli) variants are written here
+k_static_compress_types = ('.css', '.js', '.svg', '.html', '.txt', '.json')
+k_static_max_age = 365 * 24 * 60 * 60 # seconds; fingerprinted URLs change when content does, so "forever" is safe
+k_media_types = ('.mp3', '.pdf') # served by media.py (Range/If-Range/ETag, sendfile, open-file cache) rather than FileResponse
+k_media_fd_cache_size = 64 # open files kept
+k_media_revalidate_interval = 5 # seconds between checks that a cached open file hasn't been replaced on disk
+k_media_chunk_size = 256 * 1024 # bytes per read when sendfile() isn't available (e.g., TLS)
+
+# Database:
+k_db_filename = 'ohs-test.db' # user data (user, user_role, answers...); also curriculum content unless k_content_db_filename is set
+k_content_db_filename = None # e.g., 'ohs-content.db' - read-only curriculum content (event, science, resource*, ...), ATTACHed as "content"
+k_content_mmap_size = 256 * 1024 * 1024 # bytes; content db is opened immutable, so mmap is safe and cheap
+k_content_cache_size = -64 * 1024 # negative means KiB, per sqlite's `pragma cache_size` convention
+k_content_staged_suffix = '.new' # publish a new curriculum by dropping k_content_db_filename + this suffix alongside, then reloading
+k_content_watch_interval = None # e.g., 5: seconds between checks for a staged content db, which is then published without waiting for POST /admin/reload_content
+k_resource_bundle_check_interval = 10 # seconds between checks for direct edits to content in the main db (see main._watch_data_version()); None: only on reload
+k_content_in_memory = False # True: serve content from an in-memory snapshot of k_content_db_filename (see content_snapshot.py)
+k_ingest_batch_size = 10000 # rows per executemany (and, with ingest --in-place, per transaction); see ingest.py
+k_schema_dir = 'schema' # versioned migrations, schema/<track>/NNNN_*.sql; see migrate.py
+
+# Result cache and single-flight reads (see result_cache.py, single_flight.py):
+k_result_cache_bytes = 8 * 1024 * 1024 # (estimated) per db connection; 0 disables
+k_result_cache_check_interval = 1 # seconds between data_version checks; i.e., how stale a cached result may be after an outside edit
+k_single_flight = True # identical reads in flight at once share one run (for call sites that opt in; see single_flight.py)
+
+# DB admission control (see admission.py):
+k_db_concurrency = 4 # db calls admitted at once; the rest queue, by priority class
+k_db_queue_depths = {'quiz': 256, 'login': 64, 'username_check': 32, 'resource_search': 64, 'admin_list': 16} # beyond these, shed load
+k_db_deadlines = {'quiz': 5, 'login': 10, 'username_check': 2, 'resource_search': 5, 'admin_list': 10} # seconds, per request / websocket message
+k_busy_retry_ms = 1000 # suggested client retry delay when shedding load
+
+# Slow-query log (see slowlog.py):
+k_slow_query_log = None # e.g., 'slow_queries.jsonl'; None disables
+k_slow_query_ms = 100 # statements slower than this are counted, and (sampled) logged
+k_slow_query_sample = 0.1 # fraction of slow statements actually written out
+k_slow_query_log_bytes = 10 * 1024 * 1024 # rotate at this size...
+k_slow_query_log_backups = 5 # ...keeping this many old files
+
+# Event-loop lag monitor (see loop_monitor.py):
+k_loop_lag_monitor = True
+k_loop_lag_interval = 0.1 # seconds between the monitor's wake-ups; lateness is "lag"
+k_loop_lag_threshold = 0.25 # seconds; a loop held longer gets its stack logged
+
+# Profiling (see profiling.py; admin-only, at /admin/profile):
+k_profile_dir = 'profiles'
+k_profile_max_seconds = 300 # no session runs longer than this, however started
+k_profile_sample_interval = 0.005 # seconds between stack samples
+
+# Off-loop rendering (see render.py):
+k_render_workers = 2 # processes; 0 renders everything on the loop
+k_render_offload_records = 300 # renders of more records than this go to a worker
+
+# Answers (see db.Answer_Log):
+k_answer_batch_size = 100 # answers per write; reaching this many flushes at once...
+k_answer_flush_interval = 2 # ...else, seconds between flushes
+
+# Websockets:
+k_ws_heartbeat = 30 # seconds between pings; a socket whose pong doesn't come back within half of this is closed
+k_ws_idle_timeout = 30 * 60 # seconds without a message before a socket is reaped...
+k_ws_idle_timeouts = {'ws_quiz_handler': 60 * 60, 'ws_check_username': 10 * 60} # ...or, per handler
+k_ws_idle_report = 60 # seconds without a message before a socket counts as "idle" in the ws.idle gauge
+k_ws_reap_interval = 30 # seconds
+
+# Shutdown:
+k_drain_timeout = 10 # seconds, overall, to close websockets and finish DB work
+k_reconnect_delay_ms = 2000 # clients are told to reconnect after this (plus some jitter)
+
 # Quiz URLs:
 k_history_sequence = '/quiz/history/sequence'
 k_science_grammar = '/quiz/science/grammar'
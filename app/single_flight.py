@@ -0,0 +1,70 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Single-flight reads: during class, dozens of sockets send the same resource spec (this week,
+cycle 1, no search), or load the same page, within milliseconds of each other.  Rather than
+queue the same statement dozens of times for an admission slot, the first caller runs it,
+and callers with the same SQL and args, arriving while it's in flight, await that one run
+and share its result.  Opt-in, per call site (see sql.fetchall()):
+
+	return await fetchall(spec.db, (statement, args), coalesce = True)
+
+Only for reads whose result depends on nothing but their SQL, args and the data - never for
+random sampling (`order by random()`), which each caller must run for itself; those are
+refused here, even if asked for.  Shared results are shared; treat them as read-only (as with
+result_cache.py).
+
+The query runs in its own task, so that if the caller who started it goes away (its
+websocket closes, say), the others still get the result.  An exception reaches every
+caller.  (The task's stack doesn't reach back to that caller, so sql.fetchall() hands the
+slow-query log its callers beforehand; see slowlog.callers().)
+'''
+
+import asyncio
+import weakref
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import metrics
+from . import settings
+
+_flights = weakref.WeakKeyDictionary() # {db connection: {(statement, args): task}}
+
+async def run(db, sql_and_args, query):
+	'''
+	Return the result of `query()` (a coroutine function that runs `sql_and_args` on `db`),
+	or of the identical query already in flight.
+	'''
+	if not settings.k_single_flight or _random(sql_and_args[0]):
+		return await query()
+	flights = _flights.get(db)
+	if flights is None:
+		flights = _flights[db] = {}
+	key = _key(sql_and_args)
+	task = flights.get(key)
+	if task is None:
+		task = flights[key] = asyncio.ensure_future(query()) # (the task inherits this context, e.g., admission's deadline)
+		task.add_done_callback(lambda task: _landed(flights, key, task))
+	else:
+		metrics.inc('single_flight.saved')
+	return await asyncio.shield(task)
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _landed(flights, key, task):
+	if flights.get(key) is task:
+		del flights[key]
+	if not task.cancelled():
+		task.exception() # (retrieved, in case every caller has gone; each remaining caller gets it raised, anyway)
+
+def _random(statement):
+	return 'random()' in statement.lower()
+
+def _key(sql_and_args):
+	return (sql_and_args[0], tuple(sql_and_args[1]) if len(sql_and_args) > 1 else ())
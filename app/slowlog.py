@@ -0,0 +1,130 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Opt-in slow-query log (settings.k_slow_query_log).  sql.fetchone() / fetchall() (and db.py's
+direct executes) time each statement, within its admission slot (so queueing isn't counted;
+see admission.py), and hand it to check():
+	start = time.perf_counter()
+	...execute...
+	slowlog.check(start, sql_and_args, row_count)
+Statements slower than settings.k_slow_query_ms are counted (metrics 'db.slow'), and a
+sample of them (settings.k_slow_query_sample) is written, one JSON object per line, to a
+rotating file, with bind args, duration, row count, calling functions (innermost first;
+e.g., ["sql.get_surrounding_event_records", "db.History_Sequence_QT.create", "main._quiz"])
+and the handler (e.g., "ws_quiz_handler") that the query ran on behalf of.  Fast queries
+cost a perf_counter() call and a comparison.
+'''
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import time
+
+l = logging.getLogger(__name__)
+
+from . import metrics
+from . import settings
+
+handler = contextvars.ContextVar('slowlog_handler', default = None) # set per request; see main._name_handler()
+
+k_call_depth = 3 # app frames recorded per entry
+k_max_arg_length = 200
+
+_log = None # the JSON-lines logger, once configure()d
+
+def configure(filename = settings.k_slow_query_log):
+	'''
+	Idempotent: calling again (another main.init(), a Test_Loop...) with the same filename
+	changes nothing; with another, the log moves there.
+	'''
+	global _log
+	if not filename:
+		return
+	log = logging.getLogger(__name__ + '.entries')
+	path = os.path.abspath(filename)
+	if _log and any(getattr(existing, 'baseFilename', None) == path for existing in _log.handlers):
+		return
+	for existing in log.handlers[:]:
+		log.removeHandler(existing)
+		existing.close()
+	log.propagate = False # not to the console
+	log.setLevel(logging.INFO)
+	file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes = settings.k_slow_query_log_bytes, backupCount = settings.k_slow_query_log_backups)
+	file_handler.setFormatter(logging.Formatter('%(message)s'))
+	log.addHandler(file_handler)
+	_log = log
+	l.info('slow-query log: statements over %d ms (sampled at %s) to "%s"' % (settings.k_slow_query_ms, settings.k_slow_query_sample, filename))
+
+def check(start, sql_and_args, rows, callers = None):
+	'''
+	`callers`, from callers(), for a statement run away from its caller's stack; else, they're
+	taken from the stack here.
+	'''
+	if not _log:
+		return
+	duration = time.perf_counter() - start
+	if duration * 1000 < settings.k_slow_query_ms:
+		return
+	metrics.inc('db.slow')
+	if random.random() >= settings.k_slow_query_sample:
+		return
+	statement, args = sql_and_args if len(sql_and_args) > 1 else (sql_and_args[0], ())
+	_log.info(json.dumps({
+		'time': time.time(),
+		'ms': round(duration * 1000, 3),
+		'rows': rows,
+		'sql': statement,
+		'args': [_arg(arg) for arg in args],
+		'caller': callers if callers is not None else _callers(sys._getframe(1)),
+		'handler': handler.get(),
+	}, default = str))
+
+def callers():
+	'''
+	The calling functions, as check() would record them, for a statement that will run in
+	another task (e.g., single_flight.py's), whose stack doesn't reach back to its caller;
+	pass them on to check().  None (and no cost) unless the log is on.
+	'''
+	return _callers(sys._getframe(1)) if _log else None
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _arg(arg):
+	if isinstance(arg, bytes):
+		return '<%d bytes>' % len(arg) # (e.g., password hashes and salts; never log those)
+	if isinstance(arg, str) and len(arg) > k_max_arg_length:
+		return arg[:k_max_arg_length] + '...'
+	return arg
+
+def _callers(frame):
+	'''
+	The nearest k_call_depth functions in this package, outside of sql.fetchone() / fetchall()
+	(and their _fetchone() / _fetchall()).
+	'''
+	result = []
+	package = __name__.rpartition('.')[0] + '.'
+	while frame and len(result) < k_call_depth:
+		module = frame.f_globals.get('__name__', '')
+		code = frame.f_code
+		if module.startswith(package) and not (module == package + 'sql' and code.co_name in ('fetchone', 'fetchall', '_fetchone', '_fetchall')):
+			result.append('%s.%s' % (module[len(package):], _qualified_name(frame)))
+		frame = frame.f_back
+	return result
+
+def _qualified_name(frame):
+	# Prefer the actual class (e.g., Science_Grammar_QT.create, not the inherited Basic_Grammar_QT.create)
+	code = frame.f_code
+	if code.co_varnames[:1] in (('self',), ('cls',)):
+		owner = frame.f_locals.get(code.co_varnames[0])
+		if owner is not None:
+			return '%s.%s' % ((owner if isinstance(owner, type) else type(owner)).__name__, code.co_name)
+	return getattr(code, 'co_qualname', code.co_name) # (co_qualname: Python 3.11+)
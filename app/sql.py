@@ -3,13 +3,21 @@ __copyright__ = '2020'
 __version__ = '0.1'
 __license__ = 'MIT'
 
+import random
 import re
-
-from dataclasses import dataclass
+import string
+import time
 
 import logging
 l = logging.getLogger(__name__)
 
+from . import admission
+from . import cw_index
+from . import resource_bundles
+from . import result_cache
+from . import single_flight
+from . import slowlog
+
 
 # -----------------------------------------------------------------------------
 '''
@@ -17,15 +25,47 @@ Async wrappers
 Use like this:
 	fetchone(db, get_random_science_records(spec, 1))
 	fetchall(db, get_random_event_records(spec, 5))
+Each call is admitted (queued by priority, or shed) per admission.py, and timed per slowlog.py.
+fetchall(..., cache = True) serves (and keeps) results from result_cache.py, for statements
+whose results depend only on their SQL, args and the data.  For the same sort of statement,
+coalesce = True shares one run among identical, concurrent calls (see single_flight.py).
 '''
 
-async def fetchone(db, sql_and_args):
-	e = await db.execute(*sql_and_args)
-	return await e.fetchone()
-
-async def fetchall(db, sql_and_args):
-	e = await db.execute(*sql_and_args)
-	return await e.fetchall()
+async def fetchone(db, sql_and_args, coalesce = False):
+	if coalesce:
+		callers = slowlog.callers() # (the statement runs in single_flight's task, whose stack doesn't reach back here)
+		return await single_flight.run(db, sql_and_args, lambda: _fetchone(db, sql_and_args, callers))
+	return await _fetchone(db, sql_and_args)
+
+async def fetchall(db, sql_and_args, cache = False, coalesce = False):
+	if cache:
+		result = await result_cache.get(db, sql_and_args)
+		if result is not None:
+			return result
+	if coalesce:
+		callers = slowlog.callers() # (as above)
+		result = await single_flight.run(db, sql_and_args, lambda: _fetchall(db, sql_and_args, callers))
+	else:
+		result = await _fetchall(db, sql_and_args)
+	if cache:
+		result_cache.put(db, sql_and_args, result)
+	return result
+
+async def _fetchone(db, sql_and_args, callers = None):
+	async with admission.slot():
+		start = time.perf_counter()
+		e = await db.execute(*sql_and_args)
+		result = await e.fetchone()
+		slowlog.check(start, sql_and_args, 1 if result else 0, callers)
+		return result
+
+async def _fetchall(db, sql_and_args, callers = None):
+	async with admission.slot():
+		start = time.perf_counter()
+		e = await db.execute(*sql_and_args)
+		result = await e.fetchall()
+		slowlog.check(start, sql_and_args, len(result), callers)
+		return result
 
 
 # -----------------------------------------------------------------------------
@@ -40,6 +80,12 @@ def get_random_records(spec, count, exclude_ids = None):
 	`spec` object expected to be a English_Vocabulary_QT object.
 	Any records with ids in `exclude_ids` are excluded.
 	'''
+	bitmap = cw_index.select(spec.table, spec.cycles, spec.week_range)
+	if bitmap is not None: # choose, here, rather than filter, join and sort the whole table by random()
+		candidates = cw_index.ids(bitmap & ~cw_index.bits(exclude_ids))
+		chosen = random.sample(candidates, min(count, len(candidates)))
+		return f"select {_columns(spec)} from {spec.table} where id in (%s)" % ', '.join([str(i) for i in chosen]), []
+	#else:
 	joins, wheres, args = [], [], []
 	_cycle_week_range(spec, joins, wheres, args)
 	_exclude_ids(spec, wheres, exclude_ids)
@@ -113,43 +159,44 @@ async def get_surrounding_event_records(spec, count, event):
 
 
 
-async def get_resources(spec):
+class Subject_Spec:
+	__slots__ = ('subject', 'table', 'search_fields', 'deep_search_fields', 'extra_joins', 'order_by')
+	def __init__(self, subject, table, search_fields, deep_search_fields = None, extra_joins = None, order_by = 'cw.cycle, cw.week'):
+		self.subject = subject
+		self.table = table
+		self.search_fields = search_fields
+		self.deep_search_fields = deep_search_fields
+		self.extra_joins = extra_joins
+		self.order_by = order_by
+
+subject_specs = ( # A dict would work, but we'd loose the (sequencial) order, which we might like to remain consistent; even if the order itself isn't so important (timeline first?), consistency is, for the user's expectations
+	Subject_Spec('timeline', 'event', ('name', 'keywords'), ('primary_sentence', 'secondary_sentence'), None, 'cw.cycle, cw.week, event.seq'),
+	Subject_Spec('history', 'history', ('name', 'keywords', 'primary_sentence'), ('secondary_sentence',), ('event on history.event = event.id',)),
+	# Geography
+	# Math
+	Subject_Spec('science', 'science', ('prompt', 'answer'), ('note',)),
+	Subject_Spec('english_vocabulary', 'vocabulary', ('word', 'definition'), ('root','')),
+	Subject_Spec('latin_vocabulary', 'latin_vocabulary', ('word', 'translation')),
+)
+
+async def get_resources(spec, fields = None):
 	# Cycle, Week, Subject, Content (subject-specific presentation, option of "more details"), "essential" resources (e.g., song audio)
-
-	@dataclass
-	class Subject_Spec:
-		subject: str
-		table: str
-		search_fields: tuple
-		deep_search_fields: tuple = None
-		extra_joins: tuple = None
-		order_by: str = 'cw.cycle, cw.week'
-		
-	subject_specs = ( # A dict would work, but we'd loose the (sequencial) order, which we might like to remain consistent; even if the order itself isn't so important (timeline first?), consistency is, for the user's expectations
-		Subject_Spec('timeline', 'event', ('name', 'keywords'), ('primary_sentence', 'secondary_sentence'), None, 'cw.cycle, cw.week, event.seq'),
-		Subject_Spec('history', 'history', ('name', 'keywords', 'primary_sentence'), ('secondary_sentence',), ('event on history.event = event.id',)),
-		# Geography
-		# Math
-		Subject_Spec('science', 'science', ('prompt', 'answer'), ('note',)),
-		Subject_Spec('english_vocabulary', 'vocabulary', ('word', 'definition'), ('root','')),
-		Subject_Spec('latin_vocabulary', 'latin_vocabulary', ('word', 'translation')),
-	)
-
+	# `fields`: {subject: fields} (see html.resource_fields()); None: all
 	results = [] # list of 2-tuples: [(subject_spec, recordset), ...]]
 	if spec.context <= 1: # TODO: this is a temporary hardcode to grab 'grammar' resources only if the context 'Grammar' (or 'All') is chosen, since this isn't in the database yet!
 		for subject_spec in subject_specs:
 			spec.table = subject_spec.table # some lower functions want table in spec
-			results.append((subject_spec.subject, await _get_grammar_resources(spec, subject_spec)))
+			results.append((subject_spec.subject, await _get_grammar_resources(spec, subject_spec, fields.get(subject_spec.subject) if fields else None)))
 	else:
 		results.append(('external_resources', await _get_external_resources(spec)))
 
 	return results
 
-async def _get_grammar_resources(spec, subject_spec):
+async def _get_grammar_resources(spec, subject_spec, fields = None):
 	joins, wheres, args = [], [], []
 	if subject_spec.extra_joins:
 		joins.extend(subject_spec.extra_joins)
-	_cycle_week_range(spec, joins, wheres, args)
+	_cycle_week_range(spec, joins, wheres, args, True) # (joined regardless, to order by, and for html.resource_list()'s c/w display)
 	if spec.search_string and subject_spec.search_fields:
 		or_wheres = []
 		for field in subject_spec.search_fields:
@@ -157,13 +204,59 @@ async def _get_grammar_resources(spec, subject_spec):
 			args.append('%' + spec.search_string + '%')
 		wheres.append(_or_wheres(or_wheres))
 
-	return await fetchall(spec.db, (f"select * from {subject_spec.table} " + _join(joins) + _where(wheres) + f" order by {subject_spec.order_by}", args))
+	if fields and subject_spec.search_fields: # (search fields, too, so that results can be refined in memory; see refine_resources())
+		fields = tuple(fields) + tuple([field for field in subject_spec.search_fields if field not in fields])
+	columns = ', '.join(fields) if fields else '*' # (unqualified: a subject's fields may come from its extra_joins, e.g., history's from event; cycle and week from cw)
+	return await fetchall(spec.db, (f"select {columns} from {subject_spec.table} " + _join(joins) + _where(wheres) + f" order by {subject_spec.order_by}", args), cache = not spec.search_string, coalesce = True) # (searches are too varied to be worth keeping)
+
+def refines(previous, search_string):
+	'''
+	True if the results of get_resources() for `previous` (a search string, or None for no
+	search) hold all of those for `search_string`, given the same cycles, weeks and context,
+	such that refine_resources() can produce them without re-querying.  That is so if
+	`search_string` extends (contains) `previous`, since every search field that contains the
+	new string contains the old.  (Not if it has a `like` wildcard, though; see _like().)
+	'''
+	if search_string is None:
+		return previous is None
+	return not any([c in search_string for c in k_like_wildcards]) and (previous is None or _ascii_lower(previous) in _ascii_lower(search_string))
+
+def refine_resources(results, search_string):
+	'''
+	Filter `results`, from get_resources(), to the records that _get_grammar_resources()'s
+	search would select for `search_string` (see refines()).  Subjects that aren't searched
+	(external resources) are kept as they are.
+	'''
+	if search_string is None:
+		return results
+	needle = _ascii_lower(search_string)
+	refined = []
+	for subject, records in results:
+		subject_spec = _subject_specs_by_name.get(subject)
+		if subject_spec and subject_spec.search_fields:
+			records = [record for record in records if any([_like(needle, record[field]) for field in subject_spec.search_fields])]
+		refined.append((subject, records))
+	return refined
+
+_subject_specs_by_name = dict([(subject_spec.subject, subject_spec) for subject_spec in subject_specs])
 
 async def _get_external_resources(spec):
-	return await fetchall(spec.db, ('select subject.name as subject_name, resource.name as resource_name, resource.note, resource_instance.note as instance_note, resource_type.name as resource_type_name, resource_source.name as resource_source_name, resource_source.logo as resource_source_logo, resource_instance.url, resource_use.optional from resource_use join resource on resource_use.resource = resource.id join subject on resource_use.subject = subject.id join resource_instance on resource_instance.resource = resource.id join resource_type on resource_instance.type = resource_type.id join resource_source on resource_instance.source = resource_source.id join context on resource_use.context = context.id where context.id = ? order by subject_name, optional, resource_name, instance_note, resource.note', (spec.context,)))
+	bundle = resource_bundles.external(spec.context)
+	if bundle is not None:
+		return bundle
+	#else, not (yet) built:
+	return await fetchall(spec.db, (external_resources_select('where context.id = ?'), (spec.context,)), cache = True, coalesce = True)
+
+def external_resources_select(where, extra_columns = ''):
+	# (also used, without `where`, to build every context's bundle at once; see resource_bundles.py)
+	return f'select {extra_columns}subject.name as subject_name, resource.name as resource_name, resource.note, resource_instance.note as instance_note, resource_type.name as resource_type_name, resource_source.name as resource_source_name, resource_source.logo as resource_source_logo, resource_instance.url, resource_use.optional from resource_use join resource on resource_use.resource = resource.id join subject on resource_use.subject = subject.id join resource_instance on resource_instance.resource = resource.id join resource_type on resource_instance.type = resource_type.id join resource_source on resource_instance.source = resource_source.id join context on resource_use.context = context.id {where} order by subject_name, optional, resource_name, instance_note, resource.note'
 
 async def get_contexts(dbc):
-	return await fetchall(dbc, ('select * from context', []))
+	contexts = resource_bundles.contexts()
+	if contexts is not None:
+		return contexts
+	#else, not (yet) built:
+	return await fetchall(dbc, ('select * from context', []), cache = True, coalesce = True)
 
 
 # -----------------------------------------------------------------------------
@@ -187,15 +280,23 @@ def _where(wheres): # "AND"-joined wheres (i.e., intersection, not union)
 	#else:
 	return ''
  
-def _cycle_week_range(spec, joins, wheres, args):
-	if spec.week_range or spec.cycles:
+def _cycle_week_range(spec, joins, wheres, args, join_cw = False):
+	# `join_cw` for callers that want cycle_week's columns (e.g., to order by), regardless of filtering
+	if join_cw:
 		joins.append(f"cycle_week as cw on {spec.table}.cw = cw.id")
+	if not (spec.week_range or spec.cycles):
+		return # no-op
+	bitmap = cw_index.select(spec.table, spec.cycles, spec.week_range)
+	if bitmap is not None:
+		wheres.append(f"{spec.table}.id in (%s)" % ', '.join([str(i) for i in cw_index.ids(bitmap)]))
+	else: # not indexed; filter in SQL
+		if not join_cw:
+			joins.append(f"cycle_week as cw on {spec.table}.cw = cw.id")
 		if spec.week_range:
 			wheres.append("? <= cw.week and cw.week <= ?")
 			args.extend(spec.week_range)
 		if spec.cycles:
 			wheres.append("cw.cycle in (%s)" % ', '.join([str(int(i)) for i in spec.cycles]))
-	#else, no-op
 
 def _date_range(spec, wheres, args):
 	if spec.date_range:
@@ -208,14 +309,19 @@ def _exclude_ids(spec, wheres, exclude_ids):
 		wheres.append(f"{spec.table}.id not in (%s)" % ', '.join([str(e) for e in exclude_ids]))
 	#else, no-op
 
+def _columns(spec):
+	# spec.fields (see db.Question_Transaction.fields), if any, qualified by spec.table; else all
+	fields = getattr(spec, 'fields', None)
+	return ', '.join([f'{spec.table}.{field}' for field in fields]) if fields else '*'
+
 def _random_select(spec, joins, wheres, count):
-	return f"select * from {spec.table} " + _join(joins) + _where(wheres) + " order by random() limit %d" % count
+	return f"select {_columns(spec)} from {spec.table} " + _join(joins) + _where(wheres) + " order by random() limit %d" % count
 
 def _get_keyword_similar_events(spec, count, event, exids, joins, wheres):
 	keywords = list(map(str.strip, event['keywords'].split(','))) if event['keywords'] else []  # listify the comma-separated-list string
 	keywords.extend(re.findall('([A-Z][a-z]+)', event['name']))  # add all capitalized words within event's name
 	or_wheres = [f"{spec.table}.name like '%%%s%%' or {spec.table}.primary_sentence like '%%%s%%' or {spec.table}.keywords like '%%%s%%'" % (word, word, word) for word in keywords]  # injection-safe b/c keywords are safe; not derived from user input
-	return f'select * from {spec.table} %(joins)s %(wheres)s and {spec.table}.id not in (%(exids)s) and (%(orwheres)s) order by random() limit %(count)d' % {
+	return f'select {_columns(spec)} from {spec.table} %(joins)s %(wheres)s and {spec.table}.id not in (%(exids)s) and (%(orwheres)s) order by random() limit %(count)d' % {
 			'joins': _join(joins),
 			'wheres': _where(wheres),
 			'exids': ', '.join([str(e) for e in exids]),
@@ -224,10 +330,20 @@ def _get_keyword_similar_events(spec, count, event, exids, joins, wheres):
 
 def _get_temporal_random_events(spec, count, event, exids, joins, wheres):
 	k_years_away = 500 # limit to 500 year span in either direction, from event; note that date_range may provide a different scope, but who cares: the tightest scope will win
-	return f'select * from {spec.table} %(joins)s %(wheres)s and {spec.table}.id not in (%(exids)s) and event.start >= %(bottom)d and event.start <= %(top)d order by random() limit %(count)d' % {
+	return f'select {_columns(spec)} from {spec.table} %(joins)s %(wheres)s and {spec.table}.id not in (%(exids)s) and event.start >= %(bottom)d and event.start <= %(top)d order by random() limit %(count)d' % {
 			'joins': _join(joins),
 			'wheres': _where(wheres),
 			'exids': ', '.join([str(e) for e in exids]),
 			'bottom': (event['start'] if event['start'] else event['fake_start_date']) - k_years_away,
 			'top': (event['start'] if event['start'] else event['fake_start_date']) + k_years_away,
 			'count': count} # consider (postgre)sql functions instead of this giant SQL
+
+k_like_wildcards = ('%', '_')
+_k_ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def _ascii_lower(s):
+	return s.translate(_k_ascii_lower) # (sqlite's `like` folds ASCII case only; str.lower() would fold more)
+
+def _like(needle, value):
+	# In-memory equivalent of sqlite's `value like '%' || needle || '%'`, for an ASCII-lowercased `needle` free of wildcards
+	return value is not None and needle in _ascii_lower(value if type(value) is str else str(value))
@@ -0,0 +1,140 @@
+__author__ = 'J. Michael Caine'
+__copyright__ = '2020'
+__version__ = '0.1'
+__license__ = 'MIT'
+
+'''
+Optional in-app static file serving (see settings.k_serve_static), for single-box
+deployments that would rather not run a separate static server.
+
+At startup, scan() hashes every file under settings.k_static_dir into a fingerprinted
+name (css/main.css -> css/main.0123456789ab.css), and writes gzip (and, if the `brotli`
+package is installed, brotli) variants of compressible files into settings.k_static_cache_dir.
+Since a fingerprinted name changes whenever the content does, those URLs are served with
+`Cache-Control: immutable` and a far-future max-age.  Audio and PDFs (settings.k_media_types)
+are handed off to media.py, for Range support.  url() is what html.py uses to build
+static URLs; it falls back to settings.k_static_url for anything not scanned.
+'''
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from aiohttp import web
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+import logging
+l = logging.getLogger(__name__)
+
+from . import settings
+from . import media
+
+# -----------------------------------------------------------------------------
+
+class Asset:
+	def __init__(self, path, variants):
+		self.path = path # the original (identity-encoded) file
+		self.variants = variants # list of (encoding, path) pairs, in order of preference, e.g., [('br', ...), ('gzip', ...)]
+
+manifest = dict() # {'css/main.css': 'css/main.0123456789ab.css', ...}
+_assets = dict() # {'css/main.0123456789ab.css': Asset, ...}
+_unfingerprinted = dict() # {'css/main.css': Asset, ...}
+version = '' # changes whenever any static file does (so, too, any page embedding fingerprinted URLs)
+
+k_chunk_size = 256 * 1024
+k_immutable = 'public, max-age=%d, immutable' % settings.k_static_max_age
+
+def scan(directory = settings.k_static_dir, cache_directory = settings.k_static_cache_dir):
+	global version
+	manifest.clear()
+	_assets.clear()
+	_unfingerprinted.clear()
+	for root, dirs, files in os.walk(directory):
+		for filename in files:
+			path = os.path.join(root, filename)
+			name = os.path.relpath(path, directory).replace(os.sep, '/')
+			digest = _digest(path)
+			stem, ext = os.path.splitext(name)
+			fingerprinted = '%s.%s%s' % (stem, digest, ext)
+			variants = []
+			if ext in settings.k_static_compress_types:
+				variants = _compressed_variants(path, os.path.join(cache_directory, fingerprinted))
+			manifest[name] = fingerprinted
+			_assets[fingerprinted] = _unfingerprinted[name] = Asset(path, variants)
+	version = hashlib.sha256(repr(sorted(manifest.items())).encode('utf-8')).hexdigest()[:12]
+	l.info('static: %d files fingerprinted from "%s"' % (len(manifest), directory))
+
+def url(path):
+	'''
+	Return the URL for static file `path` (relative to the static directory, e.g., 'css/main.css').
+	'''
+	if path in manifest:
+		return settings.k_url_prefix + settings.k_static_route + manifest[path]
+	#else:
+	return settings.k_static_url + path
+
+async def handler(request):
+	name = request.match_info['path']
+	asset = _assets.get(name)
+	cache_control = k_immutable
+	if not asset:
+		asset = _unfingerprinted.get(name) # e.g., a hand-built URL; serve it, but don't let it be cached for long
+		cache_control = 'no-cache'
+		if not asset:
+			raise web.HTTPNotFound()
+
+	if os.path.splitext(asset.path)[1] in settings.k_media_types: # audio, pdf: Range-heavy, never precompressed
+		return await media.serve(request, asset.path, cache_control)
+
+	path, headers = asset.path, {'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+	accept_encoding = request.headers.get('Accept-Encoding', '')
+	for encoding, variant_path in asset.variants:
+		if encoding in accept_encoding:
+			path = variant_path
+			headers['Content-Encoding'] = encoding
+			headers['Content-Type'] = _content_type(asset.path) # else FileResponse would guess from the variant's (.gz/.br) filename
+			break
+	return web.FileResponse(path, headers = headers) # FileResponse uses sendfile() where the transport allows
+
+
+# -----------------------------------------------------------------------------
+# Utils:
+
+def _digest(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(k_chunk_size), b''):
+			h.update(chunk)
+	return h.hexdigest()[:12]
+
+def _compressed_variants(path, cache_base):
+	# Note that cache filenames contain the fingerprint, so existing variants from a previous run are simply re-used
+	with open(path, 'rb') as f:
+		content = None
+		variants = []
+		compressors = [('br', '.br', brotli.compress if brotli else None), ('gzip', '.gz', lambda data: gzip.compress(data, 9))]
+		for encoding, suffix, compress in compressors:
+			if not compress:
+				continue
+			variant_path = cache_base + suffix
+			if not os.path.exists(variant_path):
+				if content is None:
+					content = f.read()
+				compressed = compress(content)
+				if len(compressed) >= len(content):
+					continue # not worth it
+				os.makedirs(os.path.dirname(variant_path), exist_ok = True)
+				with open(variant_path + '.tmp', 'wb') as out:
+					out.write(compressed)
+				os.replace(variant_path + '.tmp', variant_path)
+			variants.append((encoding, variant_path))
+	return variants
+
+def _content_type(path):
+	ct, encoding = mimetypes.guess_type(path)
+	return ct or 'application/octet-stream'
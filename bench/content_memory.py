@@ -0,0 +1,64 @@
+'''
+Benchmark: content queries served from disk vs. from an in-memory snapshot
+(settings.k_content_in_memory; see app/content_snapshot.py).  Three layouts:
+	wal       - a single db, content and users together, in WAL mode (the default layout)
+	attached  - user db plus the content db ATTACHed from its file (immutable, mmap'ed)
+	in memory - user db plus an in-memory snapshot of the content db ATTACHed
+The workloads: one question of each quiz type (each db.*_QT.create()), and a resource list
+of all weeks (sql.get_resources()), each timed with db_scaffolding.Test_Loop.bench(), which
+runs the statements every time (no result cache, no single-flight), so that it's the layouts
+being compared, not cache lookups.
+
+Note that, once warmed up, the on-disk layouts are reading the OS page cache, not the disk;
+run with a cold cache (e.g., after `echo 3 > /proc/sys/vm/drop_caches`) to see the worst case.
+
+Run from the repository root, with the split layout's files alongside the single db:
+
+	$ python -m bench.content_memory [--db ohs-test.db] [--user-db ohs-user.db] [--content-db ohs-content.db] [-n 200] [--json]
+'''
+
+import argparse
+import json
+import logging
+
+from app import db
+from app import db_scaffolding as dbs
+from app import plan_audit
+from app import sql
+
+
+async def questions(dbc):
+	for cls in db._question_transactions.values():
+		await cls.create(dbc, None)
+
+async def resources(dbc):
+	return await sql.get_resources(plan_audit.Spec(dbc, None, week_range = (1, 28)))
+
+def main_(args):
+	logging.getLogger().setLevel(logging.WARNING)
+	layouts = (
+		('wal', dbs.Test_Loop(args.db, None)),
+		('attached', dbs.Test_Loop(args.user_db, args.content_db)),
+		('in memory', dbs.Test_Loop(args.user_db, args.content_db, in_memory = True)),
+	)
+	reports = []
+	for workload in (questions, resources):
+		print('%s:' % workload.__name__)
+		results = dbs.compare([(test_loop, workload) for name, test_loop in layouts], n = args.n, out = None)
+		for report, (name, test_loop) in zip(results, layouts):
+			report['layout'] = name
+			print('\t%-10s median %8.3f ms   p95 %8.3f ms   (x%.2f)' % (name, report['median'], report['p95'], report['median'] / results[0]['median']))
+		reports.extend(results)
+	for name, test_loop in layouts:
+		test_loop.close()
+	if args.json:
+		print(json.dumps(reports, indent = '\t'))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = __doc__.strip().split('\n\n')[0])
+	parser.add_argument('--db', default = 'ohs-test.db')
+	parser.add_argument('--user-db', default = 'ohs-user.db')
+	parser.add_argument('--content-db', default = 'ohs-content.db')
+	parser.add_argument('-n', type = int, default = 200)
+	parser.add_argument('--json', action = 'store_true')
+	main_(parser.parse_args())
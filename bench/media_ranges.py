@@ -0,0 +1,87 @@
+'''
+Benchmark: concurrent ranged reads of one (audio-sized) file, the way a class full of
+browsers seeking through the same week's memory song would hit it.  Compares media.serve()
+(open-file cache, sendfile at explicit offsets) with a plain aiohttp FileResponse.
+
+Run from the repository root:
+
+	$ python -m bench.media_ranges [--clients 50] [--requests 5000] [--size-mb 8] [--range-kb 64]
+'''
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from app import media
+
+
+async def run(args):
+	with tempfile.NamedTemporaryFile(suffix = '.mp3') as f:
+		f.write(os.urandom(args.size_mb * 1024 * 1024))
+		f.flush()
+		size = args.size_mb * 1024 * 1024
+
+		async def served(request):
+			return await media.serve(request, f.name)
+
+		async def baseline(request):
+			return web.FileResponse(f.name)
+
+		app = web.Application()
+		app.router.add_get('/media', served)
+		app.router.add_get('/file', baseline)
+		runner = web.AppRunner(app, access_log = None)
+		await runner.setup()
+		site = web.TCPSite(runner, '127.0.0.1', 0)
+		await site.start()
+		port = site._server.sockets[0].getsockname()[1]
+
+		try:
+			for name in ('file', 'media'):
+				latencies, elapsed = await _hammer('http://127.0.0.1:%d/%s' % (port, name), size, args)
+				total_bytes = len(latencies) * args.range_kb * 1024
+				print('%-6s %6d requests in %.2fs: %8.0f req/s, %7.1f MB/s, latency p50 %.2fms p95 %.2fms max %.2fms' % (
+					name, len(latencies), elapsed, len(latencies) / elapsed, total_bytes / elapsed / 1024 / 1024,
+					statistics.median(latencies) * 1000, _percentile(latencies, 95) * 1000, max(latencies) * 1000))
+		finally:
+			await runner.cleanup()
+			media.clear()
+
+async def _hammer(url, size, args):
+	latencies = []
+	span = args.range_kb * 1024
+	per_client = args.requests // args.clients
+
+	async def client(session):
+		for i in range(per_client):
+			first = random.randrange(0, size - span)
+			start = time.perf_counter()
+			async with session.get(url, headers = {'Range': 'bytes=%d-%d' % (first, first + span - 1)}) as response:
+				body = await response.read()
+			latencies.append(time.perf_counter() - start)
+			assert response.status == 206 and len(body) == span, (response.status, len(body))
+
+	async with aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = args.clients)) as session:
+		start = time.perf_counter()
+		await asyncio.gather(*[client(session) for i in range(args.clients)])
+		return latencies, time.perf_counter() - start
+
+def _percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--clients', type = int, default = 50)
+	parser.add_argument('--requests', type = int, default = 5000)
+	parser.add_argument('--size-mb', type = int, default = 8)
+	parser.add_argument('--range-kb', type = int, default = 64)
+	asyncio.run(run(parser.parse_args()))
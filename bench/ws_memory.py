@@ -0,0 +1,115 @@
+'''
+Measurement: memory held per websocket connection, and memory blocks left behind (for
+the cyclic garbage collector, or for good) per message, for the per-connection state of
+ws_filter_resource_list (the heaviest), before and after moving it onto module-level
+__slots__ types (main.Resource_Spec, main.Resource_List_State,
+sql.Subject_Spec / sql.subject_specs).
+
+"Before" is a faithful replica of the old code: a @dataclass Spec class defined inside the
+handler (so: a new class per connection), a msg_handler closure over it, and the
+Subject_Spec dataclass plus its five-entry table rebuilt on every sql.get_resources() call.
+No database is involved; only the state and spec setup are measured.
+
+Run from the repository root:
+
+	$ python -m bench.ws_memory [--connections 1000] [--messages 1000]
+'''
+
+import argparse
+import gc
+import tracemalloc
+
+from dataclasses import dataclass
+
+from app import main
+from app import sql
+
+
+# Before ----------------------------------------------------------------------
+
+def legacy_connection(db, url):
+	@dataclass
+	class Spec: # see sql.get_resources()
+		db: object
+		search_string: str = None
+		deep_search: bool = False
+		cycles: tuple = (0, 1)
+		week_range: tuple = (1, 1)
+		context: int = 0
+	spec = Spec(db)
+
+	async def msg_handler(payload, ws):
+		spec.context = payload # (body irrelevant here; the closure and its cell are what's kept)
+		return url
+	return spec, msg_handler
+
+def legacy_message(state):
+	spec, msg_handler = state
+	@dataclass
+	class Subject_Spec:
+		subject: str
+		table: str
+		search_fields: tuple
+		deep_search_fields: tuple = None
+		extra_joins: tuple = None
+		order_by: str = 'cw.cycle, cw.week'
+	subject_specs = (
+		Subject_Spec('timeline', 'event', ('name', 'keywords'), ('primary_sentence', 'secondary_sentence'), None, 'cw.cycle, cw.week, event.seq'),
+		Subject_Spec('history', 'history', ('name', 'keywords', 'primary_sentence'), ('secondary_sentence',), ('event on history.event = event.id',)),
+		Subject_Spec('science', 'science', ('prompt', 'answer'), ('note',)),
+		Subject_Spec('english_vocabulary', 'vocabulary', ('word', 'definition'), ('root','')),
+		Subject_Spec('latin_vocabulary', 'latin_vocabulary', ('word', 'translation')),
+	)
+	for subject_spec in subject_specs:
+		spec.table = subject_spec.table
+
+
+# After -----------------------------------------------------------------------
+
+_app = {'content_generation': 0} # (stands in for the aiohttp app, which every connection shares; the state only reads this)
+
+def current_connection(db, url):
+	return main.Resource_List_State(main.Resource_Spec(db), url, _app)
+
+def current_message(state):
+	for subject_spec in sql.subject_specs:
+		state.spec.table = subject_spec.table
+
+
+# -----------------------------------------------------------------------------
+
+def per_connection(make, n):
+	gc.collect()
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	connections = [make(None, 'http://localhost/open_resource') for i in range(n)]
+	gc.collect()
+	stats = tracemalloc.take_snapshot().compare_to(before, 'filename')
+	tracemalloc.stop()
+	size = sum(s.size_diff for s in stats)
+	del connections
+	return size / n
+
+def per_message(make, handle, n):
+	state = make(None, 'http://localhost/open_resource')
+	handle(state) # first call warms any one-time caches
+	gc.collect()
+	tracemalloc.start()
+	blocks = 0
+	for i in range(n):
+		snapshot = tracemalloc.take_snapshot()
+		handle(state)
+		blocks += sum(max(0, s.count_diff) for s in tracemalloc.take_snapshot().compare_to(snapshot, 'lineno'))
+	tracemalloc.stop()
+	return blocks / n
+
+def main_(args):
+	print('%-8s %22s %22s' % ('', 'bytes / connection', 'blocks left / message'))
+	for name, make, handle in (('before', legacy_connection, legacy_message), ('after', current_connection, current_message)):
+		print('%-8s %22.0f %22.1f' % (name, per_connection(make, args.connections), per_message(make, handle, args.messages)))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = __doc__.strip().split('\n\n')[0])
+	parser.add_argument('--connections', type = int, default = 1000)
+	parser.add_argument('--messages', type = int, default = 1000)
+	main_(parser.parse_args())
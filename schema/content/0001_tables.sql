@@ -0,0 +1,19 @@
+-- Curriculum content: grammar, by cycle and week, and external resources.
+-- Lives in the main db, or in its own (read-only) content db; see settings.k_content_db_filename.
+
+create table if not exists cycle_week (id integer primary key, cycle integer, week integer);
+
+create table if not exists event (id integer primary key, name text, cw integer, seq integer, start integer, start_circa boolean, end integer, end_circa boolean, fake_start_date integer, people_group boolean, keywords text, primary_sentence text, secondary_sentence text);
+create table if not exists history (id integer primary key, event integer, cw integer);
+create table if not exists science (id integer primary key, cw integer, prompt text, answer text, note text);
+create table if not exists vocabulary (id integer primary key, cw integer, word text, definition text, root text);
+create table if not exists english (id integer primary key, cw integer, prompt text, answer text);
+create table if not exists latin_vocabulary (id integer primary key, cw integer, word text, translation text);
+
+create table if not exists context (id integer primary key, name text);
+create table if not exists subject (id integer primary key, name text);
+create table if not exists resource (id integer primary key, name text, note text);
+create table if not exists resource_type (id integer primary key, name text);
+create table if not exists resource_source (id integer primary key, name text, logo text);
+create table if not exists resource_instance (id integer primary key, resource integer, type integer, source integer, note text, url text);
+create table if not exists resource_use (id integer primary key, resource integer, subject integer, context integer, optional boolean);
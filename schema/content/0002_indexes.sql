@@ -0,0 +1,14 @@
+-- Indexes for the query paths in sql.py (see app/plan_audit.py).
+
+create index if not exists cycle_week_cycle_week on cycle_week(cycle, week);
+
+create index if not exists event_cw_seq on event(cw, seq); -- (seq: timeline resources are ordered by cycle, week, seq)
+create index if not exists event_start on event(start);
+create index if not exists history_cw on history(cw);
+create index if not exists science_cw on science(cw);
+create index if not exists vocabulary_cw on vocabulary(cw);
+create index if not exists english_cw on english(cw);
+create index if not exists latin_vocabulary_cw on latin_vocabulary(cw);
+
+create index if not exists resource_use_context on resource_use(context, subject, resource);
+create index if not exists resource_instance_resource on resource_instance(resource);
@@ -0,0 +1,8 @@
+-- Users and roles.
+
+create table if not exists user (id integer primary key, username text unique, password blob, salt blob, email text);
+create table if not exists role (id integer primary key, name text);
+create table if not exists user_role (user integer, role integer);
+
+insert or ignore into role (id, name) values (1, 'student'); -- db.add_user() assumes role #1
+insert or ignore into role (id, name) values (2, 'admin'); -- see main.auth()
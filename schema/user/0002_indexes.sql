@@ -0,0 +1,4 @@
+-- Indexes for the query paths in db.py (see app/plan_audit.py).
+-- (user.username is already indexed, by its unique constraint.)
+
+create index if not exists user_role_user on user_role(user, role);
@@ -0,0 +1,18 @@
+-- Students' answers (see db.Answer_Log), and their incremental rollup, per user, subject
+-- (the question's table: science, event...), cycle and week, for progress views (see
+-- db.get_progress(); one primary-key range lookup per student, however long the log grows).
+
+create table if not exists answer (id integer primary key, user integer not null, subject text not null, record integer not null, chosen integer, correct boolean not null, answered real not null);
+create index if not exists answer_user_answered on answer(user, answered);
+
+create table if not exists progress (
+	user integer not null,
+	subject text not null,
+	cycle integer not null,
+	week integer not null,
+	attempts integer not null,
+	correct integer not null,
+	last_seen real not null,
+	streak integer not null, -- consecutive correct answers, most recent first
+	primary key (user, subject, cycle, week)
+) without rowid;
@@ -0,0 +1,6 @@
+-- Roles as existing databases have them: 1 student, 2 contributor, 3 admin (see main.auth()).
+-- A db seeded by 0001 has 2 = 'admin'; its admins move to role 3 before role 2 is renamed.
+
+insert or ignore into role (id, name) values (3, 'admin');
+update user_role set role = 3 where role = 2 and exists (select 1 from role where id = 2 and name = 'admin');
+update role set name = 'contributor' where id = 2 and name = 'admin';